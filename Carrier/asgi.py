@@ -3,15 +3,17 @@ import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 import chat_system.routing
-from .channelsmiddleware import JwtAuthMiddlewareStack
+from .channelsmiddleware import JwtAuthMiddlewareStack, ServerSendMiddleware
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Carrier.settings")
 
 application = ProtocolTypeRouter({
   "http": get_asgi_application(),
-  "websocket": JwtAuthMiddlewareStack(
-        URLRouter(
-            chat_system.routing.websocket_urlpatterns
+  "websocket": ServerSendMiddleware(
+        JwtAuthMiddlewareStack(
+            URLRouter(
+                chat_system.routing.websocket_urlpatterns
+            )
         )
     ),
 })
\ No newline at end of file
@@ -1,42 +1,54 @@
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.tokens import UntypedToken
 from channels.middleware import BaseMiddleware
 from channels.auth import AuthMiddlewareStack
-from django.db import close_old_connections
 from urllib.parse import parse_qs
-from jwt import decode as jwt_decode
-from django.conf import settings
+from auth_system.user_cache import token_users
+from .threadpool import db_sync_to_async
 
 
-@database_sync_to_async
-def get_user(validated_token):
+async def get_user(token):
+    # The token is decoded and verified once, the user comes from token_users when it was seen recently.
+    # db_sync_to_async closes stale connections around the lookup, on the pool the consumers use.
     try:
-        user = get_user_model().objects.get(id=validated_token["user_id"])
-        return user
+        validated_token = UntypedToken(token)
+    except (InvalidToken, TokenError):
+        return AnonymousUser()
+
+    user_id = validated_token.get(api_settings.USER_ID_CLAIM)
 
-    except get_user_model().DoesNotExist:
+    if user_id is None:
         return AnonymousUser()
 
+    jti = validated_token.get(api_settings.JTI_CLAIM)
+    user = token_users.get(user_id, jti)
+
+    if user is None:
+        user = await db_sync_to_async(token_users.load)(user_id, jti, validated_token.get('exp'))
+
+    return user or AnonymousUser()
+
 
 class JwtAuthMiddleware(BaseMiddleware):
     def __init__(self, inner):
         self.inner = inner
 
     async def __call__(self, scope, receive, send):
-        close_old_connections()
+        # Without a valid token the user is anonymous, and the consumer closes the socket
+        token = parse_qs(scope["query_string"].decode("utf8")).get("token")
+        scope["user"] = await get_user(token[0]) if token else AnonymousUser()
 
-        token = parse_qs(scope["query_string"].decode("utf8"))["token"][0]
-        try:
-            UntypedToken(token)
-        except (InvalidToken, TokenError) as e:
-            return None
-        else:
-            decoded_data = jwt_decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+        return await super().__call__(scope, receive, send)
+
+
+class ServerSendMiddleware(BaseMiddleware):
+    # Keeps the send callable of the server in scope["server_send"], before the session middleware wraps
+    # it, so consumers can reach the connection under it (chat_system.outbox.get_transport)
+    async def __call__(self, scope, receive, send):
+        scope["server_send"] = send
 
-            scope["user"] = await get_user(validated_token=decoded_data)
         return await super().__call__(scope, receive, send)
 
 
@@ -1,3 +1,8 @@
+import base64
+import binascii
+from datetime import datetime
+
+
 def validate_offset_and_limit(request):
     offset = request.query_params.get('offset') or None
     limit = request.query_params.get('limit') or None
@@ -12,3 +17,15 @@ def validate_offset_and_limit(request):
         limit = offset + limit
 
     return offset, limit
+
+
+def encode_cursor(created_at, pk):
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{pk}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
@@ -0,0 +1,162 @@
+import logging
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+logger = logging.getLogger(__name__)
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+chunk_size = 64 * 1024
+immutable_re = re.compile(settings.MEDIA_IMMUTABLE_NAMES)
+
+
+def get_etag(stat):
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def is_not_modified(request, etag, mtime):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+
+    # If-None-Match wins over If-Modified-Since, weak tags compare equal to ours
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and int(mtime) <= since
+
+
+def get_range(request, etag, mtime, size):
+    # (first, last) byte of the single range asked for, None for the whole file, False when it is not
+    # satisfiable. Several ranges at once are answered with the whole file, which HTTP allows.
+    header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    if header is None:
+        return None
+
+    # The client's partial copy is of another version of the file
+    if if_range is not None and if_range.strip() != etag and parse_http_date_safe(if_range) != int(mtime):
+        return None
+
+    match = range_re.match(header.strip())
+
+    if match is None or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+
+    if not first:
+        if int(last) == 0:
+            return False
+
+        return max(0, size - int(last)), size - 1
+
+    if last and int(last) < int(first):
+        return None
+
+    if int(first) >= size:
+        return False
+
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+
+            if not data:
+                break
+
+            length -= len(data)
+            yield data
+
+
+def offload(path, content_type):
+    # Response leaving the bytes to the front server (MEDIA_SENDFILE), None when it can not serve path
+    if settings.MEDIA_SENDFILE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        for root, location in settings.MEDIA_ACCEL_LOCATIONS.items():
+            relative = os.path.relpath(path, root)
+
+            if not relative.startswith(os.pardir):
+                response = HttpResponse(content_type=content_type)
+                response['X-Accel-Redirect'] = quote(location + relative.replace(os.sep, '/'))
+                return response
+
+    return None
+
+
+def serve_file(request, path, content_type=None, immutable=False):
+    # Conditional (ETag / Last-Modified) requests are answered here, the bytes are sent by the front server
+    # (MEDIA_SENDFILE), which also answers range requests. Without one the file or the range is streamed
+    # from here, which daphne does on the event loop, so that is for development. immutable is for files
+    # whose name changes with their content.
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+
+    if not os.path.isfile(path):
+        raise Http404
+
+    etag = get_etag(stat)
+    content_type = content_type or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    if is_not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+    else:
+        byte_range = get_range(request, etag, stat.st_mtime, stat.st_size)
+        response = offload(path, content_type) if settings.MEDIA_SENDFILE else None
+
+        if response is None and settings.MEDIA_SENDFILE:
+            logger.warning('%s is not in MEDIA_ACCEL_LOCATIONS, sending it without the front server', path)
+
+        if response is not None:
+            pass
+        elif byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+        elif byte_range is not None:
+            first, last = byte_range
+            response = StreamingHttpResponse(read_range(path, first, last - first + 1), status=206,
+                                             content_type=content_type)
+            response['Content-Range'] = f'bytes {first}-{last}/{stat.st_size}'
+            response['Content-Length'] = last - first + 1
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+
+    if immutable:
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={settings.MEDIA_MAX_AGE}'
+
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    # Replaces django.views.static.serve for MEDIA_URL
+    try:
+        full_path = default_storage.path(path)
+    except SuspiciousFileOperation:
+        raise Http404
+
+    return serve_file(request, full_path, immutable=immutable_re.match(path) is not None)
@@ -61,6 +61,90 @@ CHANNEL_LAYERS = {
         },
     },
 }
+# CHANNEL_LAYER_FANOUT=pubsub: every process subscribes once per room group through redis pub/sub and
+# delivers to its own sockets, so a room message costs one redis write per process instead of one per
+# member channel. Consumers are told (layer.reconnected) when the subscription connection was lost.
+if os.environ.get('CHANNEL_LAYER_FANOUT') == 'pubsub':
+    CHANNEL_LAYERS['default']['BACKEND'] = 'channels_redis.pubsub.RedisPubSubChannelLayer'
+    CHANNEL_LAYERS['default']['CONFIG']['on_reconnect'] = 'layer.reconnected'
+# Size of the thread pool websocket consumers use for database work
+CHANNELS_DB_THREADS = int(os.environ.get('CHANNELS_DB_THREADS', 16))
+# How many rooms one multiplexed socket (ws/chat/) may subscribe to
+CHAT_MAX_SUBSCRIPTIONS = 500
+# Binary frame image uploads (chat_system.uploads)
+CHAT_MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
+CHAT_UPLOAD_CHUNK_SIZE = 64 * 1024
+# Worker processes validating message images, and how many images may wait for them per process
+CHAT_ATTACHMENT_WORKERS = int(os.environ.get('CHAT_ATTACHMENT_WORKERS', 2))
+CHAT_ATTACHMENT_QUEUE = 256
+# Admission control and rate limits of chat sockets, per process (chat_system.throttle). Rates are
+# (per second, burst): actions are text frames, upload rates are bytes of attachments.
+CHAT_MAX_CONNECTIONS = int(os.environ.get('CHAT_MAX_CONNECTIONS', 10000))
+CHAT_MAX_USER_CONNECTIONS = 10
+CHAT_CONNECTION_ACTION_RATE = (10, 30)
+CHAT_USER_ACTION_RATE = (20, 60)
+CHAT_CONNECTION_UPLOAD_RATE = (2 * 1024 * 1024, 20 * 1024 * 1024)
+CHAT_USER_UPLOAD_RATE = (4 * 1024 * 1024, 40 * 1024 * 1024)
+CHAT_RATE_MAX_VIOLATIONS = 20
+CHAT_THROTTLE_USERS = 100000
+# Frames queued per socket once its transport holds more than CHAT_OUTBOX_TRANSPORT_BUFFER bytes the
+# client has not read, and what to give up first when the queue is full too (chat_system.outbox). A
+# client still behind is sent a resync frame and disconnected.
+CHAT_OUTBOX_SIZE = 256
+CHAT_OUTBOX_POLICIES = ['coalesce_edits', 'drop_ephemeral']
+CHAT_OUTBOX_TRANSPORT_BUFFER = 64 * 1024
+# Write-behind persistence of new messages (chat_system.writer): ids are assigned and messages broadcast
+# immediately, a writer thread inserts them in batches. Needs CHAT_WRITER_ID (0-31), different for every
+# process writing to the same database, startup fails without it.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND') == 'true'
+CHAT_WRITE_BEHIND_INTERVAL = 0.02
+CHAT_WRITE_BEHIND_BATCH = 500
+CHAT_WRITER_ID = int(os.environ['CHAT_WRITER_ID']) if os.environ.get('CHAT_WRITER_ID') else None
+# How long client_msg_ids of sends and edits are remembered for retries (chat_system.dedup), in a
+# shared cache when running more than one process. Sends are also unique per author in the database.
+CHAT_DEDUP_CACHE = os.environ.get('CHAT_DEDUP_CACHE', 'default')
+CHAT_DEDUP_TTL = 300
+# Page size of cursor paginated message history
+CHAT_MESSAGES_PAGE_SIZE = 50
+CHAT_MESSAGES_MAX_PAGE_SIZE = 200
+# Newest messages of each room kept serialized (chat_system.hot_page), off unless CHAT_HOT_PAGE_CACHE is
+# set. With more than one process it has to be the alias of a cache in CACHES they share (e.g. redis).
+CHAT_HOT_PAGE_CACHE = os.environ.get('CHAT_HOT_PAGE_CACHE')
+CHAT_HOT_PAGE_SIZE = CHAT_MESSAGES_PAGE_SIZE
+CHAT_HOT_PAGE_TTL = 60
+# Recent events per room a reconnecting client can catch up on (chat_system.replay). Set CHAT_REPLAY_REDIS
+# to a redis url to share them between processes as streams, otherwise each process keeps its own.
+CHAT_REPLAY_REDIS = os.environ.get('CHAT_REPLAY_REDIS')
+CHAT_REPLAY_SIZE = 500
+CHAT_REPLAY_ROOMS = 10000
+CHAT_REPLAY_TTL = 24 * 60 * 60
+# Square sizes and formats profile and room pictures are stored in (user.imgs), webp is skipped when
+# Pillow is built without it
+IMAGE_VARIANT_SIZES = [48, 128, 512]
+IMAGE_VARIANT_FORMATS = ['jpeg', 'webp']
+IMAGE_VARIANT_QUALITY = 85
+# Thumbnails of message images (chat_system.thumbnails), made on first request and cached on disk up to
+# CHAT_THUMBNAIL_CACHE_SIZE bytes
+CHAT_THUMBNAIL_SIZES = [256, 1024]
+CHAT_THUMBNAIL_ROOT = os.environ.get('CHAT_THUMBNAIL_ROOT', os.path.join(BASE_DIR, 'thumbnails'))
+CHAT_THUMBNAIL_CACHE_SIZE = 1024 * 1024 * 1024
+# Most results a single user search page returns (auth_system.search)
+USER_SEARCH_MAX_RESULTS = 50
+
+# Room membership lookups (chat_system.membership) and users behind websocket tokens
+# (auth_system.user_cache), both kept by Carrier.versioned_cache.
+# Alias of a cache in CACHES every process shares (e.g. redis), needed with more than one process
+CHAT_MEMBERSHIP_CACHE = os.environ.get('CHAT_MEMBERSHIP_CACHE')
+# Entries of the per-process LRU used when CHAT_MEMBERSHIP_CACHE is not set
+CHAT_MEMBERSHIP_CACHE_SIZE = 100000
+# Seconds an answer is reused
+CHAT_MEMBERSHIP_CACHE_TTL = 30
+# Like CHAT_MEMBERSHIP_CACHE
+WS_USER_CACHE = os.environ.get('WS_USER_CACHE')
+# Like CHAT_MEMBERSHIP_CACHE_SIZE
+WS_USER_CACHE_SIZE = 10000
+# Seconds a user is reused, never past the expiry of its token
+WS_USER_CACHE_TTL = 60
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
@@ -162,6 +246,30 @@ STATIC_URL = '/static/'
 
 MEDIA_ROOT = Path.joinpath(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+# Uploads are named by the sha256 of their content (Carrier.storage) and shared, see chat_system.media_refs
+DEFAULT_FILE_STORAGE = 'Carrier.storage.ContentAddressedStorage'
+# Media is served by Carrier.media. Content addressed names, and the random ones uploads had before,
+# always mean the same bytes and are cached for good, the rest (the defaults) for MEDIA_MAX_AGE.
+MEDIA_IMMUTABLE_NAMES = (r'^(users|chatrooms|messages)/([0-9a-f]{2}/[0-9a-f]{64}'
+                         r'|[0-9a-f]{8}-[0-9a-f]{3}(_\w+)?)\.\w+$')
+MEDIA_MAX_AGE = 60 * 60
+# Who sends the bytes of media files. daphne runs Django's ASGI handler, which reads file responses on the
+# event loop, so outside DEBUG the front server does: 'x-accel-redirect' for nginx, which needs an
+# internal location for each directory in MEDIA_ACCEL_LOCATIONS, e.g.
+#     location /internal/media/ { internal; alias /srv/carrier/media/; }
+#     location /internal/thumbnails/ { internal; alias /srv/carrier/thumbnails/; }
+# or 'x-sendfile' for apache (mod_xsendfile) and lighttpd. Empty sends them from Django, for development.
+MEDIA_SENDFILE = os.environ.get('MEDIA_SENDFILE', '' if DEBUG else 'x-accel-redirect') or None
+MEDIA_ACCEL_LOCATIONS = {
+    str(MEDIA_ROOT): '/internal/media/',
+    CHAT_THUMBNAIL_ROOT: '/internal/thumbnails/',
+}
+# Removal of media files nothing refers to (chat_system.media_gc, manage.py collect_media): files checked
+# per batch and per second, and how old a file has to be before it may go
+MEDIA_GC_STATE_FILE = os.environ.get('MEDIA_GC_STATE_FILE', os.path.join(BASE_DIR, 'media_gc.json'))
+MEDIA_GC_BATCH = 500
+MEDIA_GC_RATE = 2000
+MEDIA_GC_GRACE = 60 * 60
 
 STATICFILES_DIRS = [
     BASE_DIR / "static",
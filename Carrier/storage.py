@@ -0,0 +1,77 @@
+import hashlib
+import os
+import tempfile
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    # Names every file by the sha256 of its content: "<directory of the given name>/<2 hex>/<sha256>.<ext>".
+    # Saving bytes that are already stored writes nothing and returns the existing name, so a picture
+    # forwarded to many rooms is kept once and a name always means the same bytes (see MEDIA_IMMUTABLE_NAMES).
+    # Files are shared between rows, chat_system.media_refs counts who uses them.
+    chunk_size = 64 * 1024
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        content.seek(0)
+
+        for chunk in content.chunks(self.chunk_size):
+            digest.update(chunk)
+
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower().replace('.jpeg', '.jpg')
+        digest = digest.hexdigest()
+
+        return os.path.join(directory, digest[:2], digest + extension).replace(os.sep, '/')
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = self.get_content_name(self.generate_filename(name), content)
+
+        try:
+            # Reused by a new upload, it counts as new for the garbage collector's grace period
+            os.utime(self.path(name))
+            return name
+        except FileNotFoundError:
+            return self._save(name, content)
+
+    def get_available_name(self, name, max_length=None):
+        # The same name is the same content, there is nothing to make unique
+        return name
+
+    def _save(self, name, content):
+        # Written aside and moved into place, so a concurrent save of the same content (or a reader) never
+        # sees half a file, and losing that race is harmless
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+
+        try:
+            if hasattr(content, 'temporary_file_path'):
+                os.close(fd)
+                file_move_safe(content.temporary_file_path(), temp_path, allow_overwrite=True)
+            else:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in content.chunks(self.chunk_size):
+                        f.write(chunk)
+
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+
+            os.replace(temp_path, full_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return name
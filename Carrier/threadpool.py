@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers=None, thread_name_prefix=''):
+        super().__init__(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._stats_lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, fn, /, *args, **kwargs):
+        queued_at = time.monotonic()
+
+        with self._stats_lock:
+            self.queued += 1
+
+        def run():
+            waited = time.monotonic() - queued_at
+
+            with self._stats_lock:
+                self.queued -= 1
+                self.running += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._stats_lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        future = super().submit(run)
+        future.add_done_callback(self._forget_cancelled)
+        return future
+
+    def _forget_cancelled(self, future):
+        # A cancelled future never reached run(), so it is still counted as queued
+        if future.cancelled():
+            with self._stats_lock:
+                self.queued -= 1
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'max_workers': self._max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'avg_wait_ms': round(self.total_wait / self.completed * 1000, 3) if self.completed else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+            }
+
+
+db_executor = InstrumentedThreadPoolExecutor(max_workers=settings.CHANNELS_DB_THREADS,
+                                             thread_name_prefix='channels-db')
+
+
+def db_sync_to_async(func):
+    # Like channels' database_sync_to_async, but runs on our own sized pool instead of the single
+    # thread asgiref shares for thread sensitive code, so one busy room can not stall every socket.
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=db_executor)
@@ -16,15 +16,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static, serve
+from .media import serve_media
 
 urlpatterns = [
     path('user/', include('user.urls')),
     path('friend/', include('friend.urls')),
     path('chat/', include('chat_system.urls')),
     path('auth/', include('auth_system.urls')),
-    re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    re_path(r'^media/(?P<path>.*)$', serve_media),
+]
 
 if settings.DEBUG:
     urlpatterns += [path('admin/', admin.site.urls)]
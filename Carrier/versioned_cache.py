@@ -0,0 +1,90 @@
+import random
+import time
+from collections import OrderedDict
+from threading import Lock
+from django.core.cache import caches
+
+
+class VersionedCache:
+    # Values keyed by (group, item), e.g. (room, user), kept for at most ttl seconds. A bounded per-process
+    # LRU, or the cache in CACHES named by shared_cache (e.g. redis) when set, so a change made in one process
+    # reaches the others. There a whole group is dropped at once by moving it to a new version, versions
+    # start at a random number so an evicted version can not bring old values back.
+    def __init__(self, prefix, max_size, ttl, shared_cache=None):
+        self.prefix = prefix
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    @property
+    def shared(self):
+        return caches[self.shared_cache] if self.shared_cache else None
+
+    def version_key(self, group):
+        return f'{self.prefix}-version:{group}'
+
+    def shared_key(self, group, item):
+        version = self.shared.get_or_set(self.version_key(group), lambda: random.getrandbits(62), None)
+        return f'{self.prefix}:{group}:{version}:{item}'
+
+    def peek(self, group, item):
+        # Without touching the network, so always None with a shared cache
+        if self.shared_cache:
+            return None
+
+        with self.lock:
+            entry = self.entries.get((group, item))
+
+            if entry is None:
+                return None
+
+            if entry[0] < time.monotonic():
+                del self.entries[(group, item)]
+                return None
+
+            self.entries.move_to_end((group, item))
+            return entry[1]
+
+    def get(self, group, item):
+        if self.shared_cache:
+            return self.shared.get(self.shared_key(group, item))
+
+        return self.peek(group, item)
+
+    def set(self, group, item, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+
+        if self.shared_cache:
+            self.shared.set(self.shared_key(group, item), value, ttl)
+            return
+
+        with self.lock:
+            self.entries[(group, item)] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end((group, item))
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, group, items=None):
+        # Every item of the group when items is None
+        with self.lock:
+            if items is None:
+                for key in [key for key in self.entries if key[0] == group]:
+                    del self.entries[key]
+            else:
+                for item in items:
+                    self.entries.pop((group, item), None)
+
+        if not self.shared_cache:
+            return
+
+        if items is None:
+            try:
+                self.shared.incr(self.version_key(group))
+            except ValueError:
+                # No version, so nothing cached for the group either
+                pass
+        else:
+            self.shared.delete_many([self.shared_key(group, item) for item in items])
@@ -0,0 +1,16 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from auth_system.search import index_user
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the user search index for every account'
+
+    def handle(self, *args, **options):
+        count = 0
+
+        for user in get_user_model().objects.iterator():
+            index_user(user)
+            count += 1
+
+        self.stdout.write(f'Indexed {count} users')
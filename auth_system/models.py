@@ -10,6 +10,8 @@ import string
 
 class CustomUser(AbstractUser):
     pfp = models.ImageField(upload_to="users/", default="users/default.png")
+    # Storage names of the resized copies of pfp, {size: {format: name}}, see user.imgs
+    pfp_variants = models.JSONField(default=dict, blank=True)
 
     REQUIRED_FIELDS = ['password', 'first_name', 'last_name', 'email']
 
@@ -101,3 +103,21 @@ class EmailRenewCode(models.Model):
         self.user.save()
 
         self.delete()
+
+
+class UserSearchToken(models.Model):
+    # Normalized word prefixes of a user's names, maintained by auth_system.search
+    user = models.ForeignKey(get_user_model(), on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=16)
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'token'], name='unique_user_search_token'),
+        ]
+        indexes = [
+            models.Index(fields=['token', 'weight', 'user'], name='user_search_token_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.token} -> {self.user_id}'
@@ -0,0 +1,67 @@
+import re
+import unicodedata
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, Exists, OuterRef, When
+from .models import UserSearchToken
+
+MAX_TOKEN_LENGTH = UserSearchToken._meta.get_field('token').max_length
+# A whole word outranks a prefix of one
+WORD_WEIGHT = 2
+PREFIX_WEIGHT = 1
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text, max_length=MAX_TOKEN_LENGTH):
+    return [word[:max_length] for word in re.findall(r'[^\W_]+', normalize(text))]
+
+
+def get_tokens(user):
+    words = tokenize(user.first_name) + tokenize(user.last_name) + tokenize(user.username)
+    tokens = {}
+
+    for word in words:
+        for i in range(1, len(word) + 1):
+            weight = WORD_WEIGHT if i == len(word) else PREFIX_WEIGHT
+            tokens[word[:i]] = max(tokens.get(word[:i], 0), weight)
+
+    return tokens
+
+
+@transaction.atomic
+def index_user(user):
+    UserSearchToken.objects.filter(user=user).delete()
+    UserSearchToken.objects.bulk_create([UserSearchToken(user=user, token=token, weight=weight)
+                                         for token, weight in get_tokens(user).items()])
+
+
+def search_users(query, offset=None, limit=None):
+    # Every word of the query has to prefix one of the user's words. The longest word drives an ordered
+    # range scan of the token index, the others are checked per candidate, so a page costs the same
+    # no matter how many accounts there are. offset/limit are slice bounds, as validate_offset_and_limit
+    # returns them, capped at USER_SEARCH_MAX_RESULTS.
+    words = list(dict.fromkeys(tokenize(query)))
+    offset = offset or 0
+    limit = min(limit if limit is not None else offset + settings.USER_SEARCH_MAX_RESULTS,
+                offset + settings.USER_SEARCH_MAX_RESULTS)
+
+    if not words:
+        return get_user_model().objects.none()
+
+    driver = max(words, key=len)
+    tokens = UserSearchToken.objects.filter(token=driver)
+
+    for word in words:
+        if word != driver:
+            tokens = tokens.filter(Exists(UserSearchToken.objects.filter(user=OuterRef('user'), token=word)))
+
+    user_ids = list(tokens.order_by('-weight', '-user_id').values_list('user_id', flat=True)[offset:limit])
+
+    return get_user_model().objects.filter(pk__in=user_ids).order_by(
+        Case(*[When(pk=pk, then=position) for position, pk in enumerate(user_ids)])) if user_ids else \
+        get_user_model().objects.none()
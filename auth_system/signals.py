@@ -0,0 +1,21 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework_simplejwt.settings import api_settings
+from .search import index_user
+from .user_cache import token_users
+
+
+@receiver(post_save, sender=get_user_model())
+def update_search_index(sender, instance, created, update_fields, **kwargs):
+    # Saves like last_login updates do not touch the names
+    if update_fields is not None and not {'first_name', 'last_name', 'username'} & set(update_fields):
+        return
+
+    index_user(instance)
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def invalidate_token_users(sender, instance, **kwargs):
+    token_users.invalidate(getattr(instance, api_settings.USER_ID_FIELD))
@@ -0,0 +1,46 @@
+import time
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.settings import api_settings
+from Carrier.versioned_cache import VersionedCache
+
+
+class TokenUserCache:
+    # Users behind recently validated access tokens, keyed by user id and token jti, so a reconnect storm
+    # after a deploy does not turn into one user query per websocket handshake. Entries live at most ttl
+    # and never past the token's expiry, and are dropped when the user is saved or deleted. Per process,
+    # or shared when WS_USER_CACHE is set, see Carrier.versioned_cache. Cached users are shared between
+    # sockets and must not be modified.
+    def __init__(self, max_size, ttl, shared_cache=None):
+        self.cache = VersionedCache('ws-user', max_size, ttl, shared_cache)
+
+    def get(self, user_id, jti):
+        # Without touching the database or the network, None when the user has to be loaded
+        return self.cache.peek(user_id, jti)
+
+    def load(self, user_id, jti, expires=None):
+        # The user, or None when it does not exist (anymore). Blocking, run it in a thread.
+        user = self.cache.get(user_id, jti)
+
+        if user is not None:
+            return user
+
+        user = get_user_model().objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+
+        if user is None:
+            return None
+
+        ttl = self.cache.ttl if expires is None else min(self.cache.ttl, expires - time.time())
+
+        if ttl > 0:
+            self.cache.set(user_id, jti, user, ttl)
+
+        return user
+
+    def invalidate(self, user_id):
+        self.cache.invalidate(user_id)
+
+
+token_users = TokenUserCache(max_size=settings.WS_USER_CACHE_SIZE,
+                             ttl=settings.WS_USER_CACHE_TTL,
+                             shared_cache=settings.WS_USER_CACHE)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ChatSystemConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat_system'
+
+    def ready(self):
+        from . import signals
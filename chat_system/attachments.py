@@ -0,0 +1,124 @@
+import asyncio
+import base64
+import binascii
+import imghdr
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.files import File
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+allowed_extensions = ['jpg', 'jpeg', 'png']
+
+
+def process_attachment(source, is_path, temp_dir=None):
+    # Runs in a worker process. source is the path of a streamed upload or a base64 string, returns
+    # (path, extension, width, height) for a valid image or None.
+    path = source
+
+    if not is_path:
+        if 'data:' in source and ';base64,' in source:
+            source = source.split(';base64,')[1]
+
+        try:
+            decoded_file = base64.b64decode(source)
+        except (binascii.Error, ValueError):
+            return None
+
+        fd, path = tempfile.mkstemp(suffix='.upload', dir=temp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(decoded_file)
+
+    extension = imghdr.what(path)
+    extension = "jpg" if extension == "jpeg" else extension
+
+    try:
+        if extension not in allowed_extensions:
+            raise ValueError(extension)
+
+        with Image.open(path) as img:
+            width, height = img.size
+            img.verify()
+    except Exception:
+        if not is_path:
+            os.remove(path)
+        return None
+
+    return path, extension, width, height
+
+
+class ProcessedImage(File):
+    # Lets FileSystemStorage move the processed file into place instead of copying it
+    def __init__(self, path, extension, width, height):
+        # Named by its content once stored, see Carrier.storage
+        super().__init__(open(path, 'rb'), name=f'image.{extension}')
+        self.path = path
+        self.width = width
+        self.height = height
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        super().close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AttachmentPool:
+    # Validates message images in a bounded pool of worker processes, off the event loop. Settings are
+    # read on first use, this module is imported by the spawned workers which have no Django setup.
+    def __init__(self):
+        self.executor = None
+        self.semaphore = None
+        self.tasks = set()
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=settings.CHAT_ATTACHMENT_WORKERS,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    async def process(self, source):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(settings.CHAT_ATTACHMENT_QUEUE)
+
+        # Streamed uploads arrive as temporary files, legacy clients send base64 strings
+        is_path = hasattr(source, 'temporary_file_path')
+        if is_path:
+            source = source.temporary_file_path()
+        elif not isinstance(source, str):
+            return None
+
+        async with self.semaphore:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.get_executor(), process_attachment,
+                                                source, is_path, settings.FILE_UPLOAD_TEMP_DIR)
+
+        return None if result is None else ProcessedImage(*result)
+
+    async def process_all(self, sources):
+        # An image that fails is left out like an invalid one, the others are still returned (and closed by
+        # the caller)
+        images = await asyncio.gather(*[self.process(source) for source in sources], return_exceptions=True)
+
+        for image in images:
+            if isinstance(image, Exception):
+                logger.error('Attachment could not be processed', exc_info=image)
+
+        return [image for image in images if isinstance(image, ProcessedImage)]
+
+    def spawn(self, coroutine):
+        # Keep a reference so the task is not garbage collected if the socket that started it goes away
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+
+attachment_pool = AttachmentPool()
@@ -1,7 +1,6 @@
 from django.core.files.base import ContentFile
 import base64
 import six
-import uuid
 
 
 def get_file_extension(file_name, decoded_file):
@@ -29,8 +28,8 @@ def decode_base64_to_image(data):
     except TypeError:
         return
 
-    # Generate file name:
-    file_name = str(uuid.uuid4())[:12]  # 12 characters are more than enough.
+    # Storage names the file by its content
+    file_name = 'image'
     # Get the file name extension:
     file_extension = get_file_extension(file_name, decoded_file)
 
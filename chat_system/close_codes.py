@@ -0,0 +1,7 @@
+# Close codes of chat sockets, 4000-4999 is left to applications by RFC 6455
+UNAUTHENTICATED = 4001
+FORBIDDEN = 4003
+SLOW_CONSUMER = 4008
+TOO_MANY_CONNECTIONS = 4009
+OVERLOADED = 4013
+RATE_LIMITED = 4029
@@ -1,160 +1,751 @@
+import asyncio
 import json
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from .models import Message, ChatRoom, MessageImage
-from .serializer import WSMessageSerializer
-from .base64 import decode_base64_to_image
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from channels.generic.websocket import AsyncWebsocketConsumer
+from Carrier.threadpool import db_sync_to_async
+from friend.relations import RelationshipOverlay, relationship_group_name
+from . import error_code
+from .models import ChatRoom, Message, MessageImage
+from .membership import membership
+from .media_refs import add_references
+from .search import index_message
+from .serializer import WSMessageSerializer, WSFriendSerializer, get_new_message_data
+from .attachments import attachment_pool
+from .uploads import Upload
+from .replay import replay_buffer
+from .hot_page import hot_pages
+from .writer import message_writer
+from .dedup import dedup
+from .outbox import Outbox, EPHEMERAL, EDIT, EVENT, CONTROL, get_transport
+from .throttle import ConnectionThrottle
+from . import close_codes
+
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(room):
+    return f'chat_{room}'
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    # One socket per client. Rooms are joined with {"action": "subscribe", "room": pk} and every frame
+    # in either direction carries the room it belongs to.
+    connections = 0
+
+    # Frame action of each group event type
+    event_actions = {
+        'send_message': 'send',
+        'edit_message': 'edit',
+        'delete_message': 'delete',
+        'attachments_ready': 'attachments_ready',
+        'message_failed': 'send_failed',
+    }
+
+    max_pending_uploads = 4
+
+    def setup(self):
+        self.rooms = set()
+        self.relationships = RelationshipOverlay(self.scope['user'])
+        self.upload = None
+        self.uploads = {}
+        self.outbox = None
+        self.throttle = None
+        # WSFriendSerializer data of the user, as of connecting like the rest of scope['user']
+        self.author_data = None
+
+    async def connect(self):
+        self.setup()
+
+        if not self.scope['user'].is_authenticated:
+            await self.refuse(close_codes.UNAUTHENTICATED)
+            return
+
+        await self.accept_connection()
+
+    # Close codes only reach the client once the handshake is accepted
+    async def refuse(self, code):
+        await self.accept()
+        await self.close(code=code)
+
+    async def admit(self):
+        # Returns False when the socket is refused: this process or the user has too many already
+        code = ConnectionThrottle.admit(self.scope['user'], ChatConsumer.connections)
+
+        if code is not None:
+            await self.refuse(code)
+            return False
+
+        return True
+
+    async def accept_connection(self):
+        # Returns False when the socket is refused, see admit
+        if not await self.admit():
+            return False
+
+        await self.accept()
+        self.loop = asyncio.get_running_loop()
+        self.counted = True
+        ChatConsumer.connections += 1
+
+        self.throttle = ConnectionThrottle(self.scope['user'])
+        self.throttle.open()
+        self.outbox = Outbox(self.write, self.close, settings.CHAT_OUTBOX_SIZE, settings.CHAT_OUTBOX_POLICIES,
+                             settings.CHAT_OUTBOX_TRANSPORT_BUFFER)
+        self.outbox.start(get_transport(self.scope.get('server_send')))
+
+        # Joined before loading, so a change made meanwhile still reloads the overlay
+        await self.channel_layer.group_add(relationship_group_name(self.scope['user'].pk), self.channel_name)
+        await db_sync_to_async(self.relationships.load)()
+
+        return True
+
+    # Frames go through the outbox once the socket is accepted, kind and key tell it what may be coalesced
+    # or dropped for a client that falls behind
+    async def send(self, text_data=None, bytes_data=None, close=False, kind=CONTROL, key=None):
+        if self.outbox is None or bytes_data is not None or close:
+            await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+            return
+
+        self.outbox.put(text_data, kind, key)
+
+    async def write(self, text_data):
+        await super().send(text_data=text_data)
+
+    async def disconnect(self, close_code):
+        # Leave room groups
+        for room in self.rooms:
+            await self.channel_layer.group_discard(
+                room_group_name(room),
+                self.channel_name
+            )
+
+        self.rooms = set()
+        self.abort_upload()
+
+        for upload in self.uploads.values():
+            upload.close()
+
+        self.uploads = {}
+
+        if self.outbox is not None:
+            self.outbox.stop()
+
+        if self.throttle is not None:
+            self.throttle.close()
 
+        if getattr(self, 'counted', False):
+            ChatConsumer.connections -= 1
+            await self.channel_layer.group_discard(relationship_group_name(self.scope['user'].pk),
+                                                   self.channel_name)
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
-        self.room_name = self.scope['url_route']['kwargs']['room_name']
-        self.room_group_name = f'chat_{self.room_name}'
+    async def subscribe(self, room):
+        if room in self.rooms:
+            return True
 
-        if not ChatRoom.objects.get(pk=self.room_name).is_user_in_chat_room(self.scope['user']):
-            self.close()
+        if len(self.rooms) >= settings.CHAT_MAX_SUBSCRIPTIONS:
+            await self.send_error(error_code.TOO_MANY_SUBSCRIPTIONS, room)
+            return False
+
+        if not await self.can_join(room):
+            await self.send_error(error_code.USER_NOT_MEMBER, room)
+            return False
 
         # Join room group
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_name,
+        await self.channel_layer.group_add(
+            room_group_name(room),
             self.channel_name
         )
+        self.rooms.add(room)
+
+        return True
 
-        self.accept()
+    async def unsubscribe(self, room):
+        if room not in self.rooms:
+            return
 
-    def disconnect(self, close_code):
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name,
+        await self.channel_layer.group_discard(
+            room_group_name(room),
             self.channel_name
         )
+        self.rooms.discard(room)
+
+    def abort_upload(self):
+        if self.upload is not None:
+            self.upload.close()
+            self.upload = None
+
+    def pop_upload(self, upload_id):
+        return self.uploads.pop(upload_id, None) if isinstance(upload_id, str) else None
+
+    async def get_attachments(self, text_data_json, room):
+        # Returns (images, upload), images is None when the frame has no attachments and False when it is invalid
+        images = text_data_json.get('images')
+        upload = None
+
+        if text_data_json.get('upload') is not None:
+            upload = self.pop_upload(text_data_json.get('upload'))
+
+            if upload is None:
+                await self.send_error(error_code.NO_UPLOAD, room)
+                return False, None
+
+            images = upload.files
+
+        if images is not None and (not isinstance(images, list) or len(images) > Message.max_images):
+            return False, upload
+
+        # Uploaded files were paid for chunk by chunk, inline base64 images are paid for here
+        if upload is None and images and not self.throttle.allow_bytes(
+                sum(len(image) for image in images if isinstance(image, str))):
+            await self.rate_limited(room)
+            return False, None
+
+        return images, upload
+
+    # Validate and store attachments in the background, then tell the room they are ready
+    async def store_attachments(self, room, message_pk, sources, upload):
+        images = []
+        failed = False
+        try:
+            images = await attachment_pool.process_all(sources)
+            payload = await self.attach_images(message_pk, images)
+        except Exception:
+            logger.exception('Images of message %s could not be stored', message_pk)
+            failed = True
+        finally:
+            for image in images:
+                image.close()
+
+            if upload is not None:
+                upload.close()
+
+        if failed:
+            # Nothing was stored, clients wait for the pending images until pending_images says so
+            try:
+                payload = await self.attach_images(message_pk, [])
+            except Exception:
+                logger.exception('Pending images of message %s could not be cleared', message_pk)
+                return
+
+        if payload is None:
+            return
+
+        await self.broadcast(room, 'attachments_ready', payload)
+
+    # Binary frames are chunks of the upload started by the last "upload" action
+    async def receive_chunk(self, chunk):
+        upload = self.upload
+        # Charged before anything else, a frame without an upload costs an action like a text frame
+        allowed = self.throttle.allow_action() if upload is None else self.throttle.allow_bytes(len(chunk))
+
+        if not allowed:
+            self.abort_upload()
+            await self.rate_limited()
+            return
+
+        if upload is None:
+            await self.send_error(error_code.INVALID_UPLOAD)
+            return
+
+        if not await sync_to_async(upload.write, thread_sensitive=False)(chunk):
+            self.abort_upload()
+            await self.send_error(error_code.INVALID_UPLOAD)
+            return
+
+        if upload.complete:
+            self.upload = None
+            self.uploads[upload.id] = upload
+            await self.send(text_data=json.dumps({'action': 'upload_complete', 'upload': upload.id}))
+
+    # Record an event in the replay buffer and send it to the room group
+    async def broadcast(self, room, event_type, payload):
+        event = {
+            'type': event_type,
+            'room': room,
+            'message': payload
+        }
+        event['event_id'] = await replay_buffer.append(room, event)
+
+        await self.channel_layer.group_send(room_group_name(room), event)
+
+    # Send the events of room after last_event_id, or a resync frame when they are no longer buffered and
+    # the client has to refetch the history. Events broadcast meanwhile may arrive twice, clients skip
+    # event ids they have already seen.
+    async def replay(self, room, last_event_id):
+        events = await replay_buffer.since(room, last_event_id)
+
+        if events is None:
+            await self.send(text_data=json.dumps({'action': 'resync', 'room': room}))
+            return
+
+        for event in events:
+            await self.send(text_data=await self.personalize(event, self.event_actions[event['type']]), kind=EVENT)
+
+        await self.send(text_data=json.dumps({'action': 'replayed', 'room': room, 'count': len(events)}))
+
+    async def get_client_msg_id(self, text_data_json, room):
+        # client_msg_id of a send/edit, None when there is none and False when it is invalid
+        client_msg_id = text_data_json.get('client_msg_id')
+
+        if client_msg_id is None:
+            return None
+
+        if not isinstance(client_msg_id, str) or \
+                not 0 < len(client_msg_id) <= Message._meta.get_field('client_msg_id').max_length:
+            await self.send_error(error_code.INVALID_CLIENT_MSG_ID, room)
+            return False
+
+        return client_msg_id
+
+    # Tells the sender which message its client_msg_id ended up as, duplicate when it was a retry
+    async def send_ack(self, room, client_msg_id, message_id, duplicate):
+        await self.send(text_data=json.dumps({'action': 'ack',
+                                              'room': room,
+                                              'client_msg_id': client_msg_id,
+                                              'id': message_id,
+                                              'duplicate': duplicate}))
+
+    async def send_error(self, error, room=None, **fields):
+        await self.send(text_data=json.dumps(dict(error, action='error', room=room, **fields)))
+
+    # The frame is dropped, a client that keeps going regardless is disconnected
+    async def rate_limited(self, room=None):
+        if self.throttle.exhausted:
+            ConnectionThrottle.counters['rate_limit_closes'] += 1
+            await self.close(code=close_codes.RATE_LIMITED)
+            return
+
+        await self.send_error(error_code.RATE_LIMITED, room)
+
+    def get_room(self, text_data_json):
+        try:
+            return int(text_data_json.get('room'))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def get_message_pk(text_data_json):
+        try:
+            return int(text_data_json.get('message_pk'))
+        except (TypeError, ValueError):
+            return None
 
     # Receive message from WebSocket
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.throttle is None:
+            # Refused, frames sent before the close arrived are ignored
+            return
+
+        if bytes_data is not None:
+            await self.receive_chunk(bytes_data)
+            return
+
+        if not self.throttle.allow_action():
+            await self.rate_limited()
+            return
+
+        try:
+            text_data_json = json.loads(text_data)
+        except (TypeError, ValueError):
+            await self.close()
+            return
+
+        if not isinstance(text_data_json, dict):
+            await self.send_error(error_code.INVALID_FRAME)
+            return
+
         action = text_data_json.get('action')
+        room = self.get_room(text_data_json)
+
+        if room is None:
+            await self.send_error(error_code.NO_ROOM_PK)
+            return
+
+        if action == 'subscribe':
+            # {"action": "subscribe", "room": pk, "last_event_id": id} also replays what was missed
+            if await self.subscribe(room):
+                await self.send(text_data=json.dumps({'action': 'subscribed', 'room': room}))
+
+                if text_data_json.get('last_event_id') is not None:
+                    await self.replay(room, text_data_json.get('last_event_id'))
+            return
+
+        elif action == 'unsubscribe':
+            await self.unsubscribe(room)
+            await self.send(text_data=json.dumps({'action': 'unsubscribed', 'room': room}))
+            return
+
+        if room not in self.rooms:
+            await self.send_error(error_code.NOT_SUBSCRIBED, room)
+            return
+
+        if action == 'typing':
+            # Not stored or replayed, the first thing dropped for a client that falls behind
+            await self.channel_layer.group_send(
+                room_group_name(room),
+                {
+                    'type': 'typing',
+                    'room': room,
+                    'user': self.scope['user'].pk
+                }
+            )
+
+        elif action == 'resume':
+            # {"action": "resume", "room": pk, "last_event_id": id}
+            await self.replay(room, text_data_json.get('last_event_id'))
 
-        if action == 'send':
-            message = text_data_json.get('message')
-            images = text_data_json.get('images')
+        elif action == 'upload':
+            # {"action": "upload", "room": pk, "attachments": [{"size": bytes}, ...]}, then binary frames
+            sizes = Upload.validate_sizes(text_data_json.get('attachments'))
 
-            if not message and not images:
+            if sizes is None or len(self.uploads) >= self.max_pending_uploads:
+                await self.send_error(error_code.INVALID_UPLOAD, room)
                 return
 
-            user = self.scope['user']
-            chat_room = ChatRoom.objects.get(pk=self.room_name)
+            self.abort_upload()
+            self.upload = Upload(sizes)
+            await self.send(text_data=json.dumps({'action': 'upload_ready', 'room': room, 'upload': self.upload.id}))
+
+        elif action == 'send':
+            message = text_data_json.get('message') or ''
+            client_msg_id = await self.get_client_msg_id(text_data_json, room)
 
-            if user not in chat_room.users.all():
-                self.disconnect()
+            if client_msg_id is False:
                 return
 
-            if len(message) > Message._meta.get_field('content').max_length:
+            images, upload = await self.get_attachments(text_data_json, room)
+
+            if images is False or (not message and not images):
+                if upload is not None:
+                    upload.close()
                 return
 
-            message = Message.objects.create(author=user, chat_room=chat_room, content=message)
-            message_pk = message.pk
+            payload, duplicate = await self.create_message(room, message, len(images or []), client_msg_id)
 
-            if images is not None and isinstance(images, list):
-                if len(images) > Message.max_images:
-                    return
+            if payload is None and duplicate:
+                await self.send_error(error_code.IN_PROGRESS, room, client_msg_id=client_msg_id)
+            elif payload is not None and client_msg_id is not None:
+                await self.send_ack(room, client_msg_id, payload['id'], duplicate)
 
-                for image in images:
-                    decoded_image = decode_base64_to_image(image)
-                    if decoded_image.name.split('.')[-1] not in ['jpg', 'jpeg', 'png']:
-                        return
+            if payload is None or duplicate:
+                if upload is not None:
+                    upload.close()
+                return
 
-                    MessageImage.objects.create(author=user, message=message, image=decoded_image)
+            await self.broadcast(room, 'send_message', payload)
 
-            # Send message to room group
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {
-                    'type': 'send_message',
-                    'message': message_pk
-                }
-            )
+            if images:
+                attachment_pool.spawn(self.store_attachments(room, payload['id'], images, upload))
         elif action == 'edit':
-            message_pk = text_data_json.get('message_pk')
-            images = text_data_json.get('images')
+            message_pk = self.get_message_pk(text_data_json)
 
-            if not message_pk:
+            if message_pk is None:
+                await self.send_error(error_code.NO_MESSAGE_PK, room)
                 return
 
-            message = Message.objects.get(pk=message_pk)
+            client_msg_id = await self.get_client_msg_id(text_data_json, room)
 
-            if message.author != self.scope['user']:
+            if client_msg_id is False:
                 return
 
-            message.content = text_data_json.get('content')
-            message.save()
+            images, upload = await self.get_attachments(text_data_json, room)
 
-            if images is not None and isinstance(images, list):
-                if len(images) > Message.max_images:
-                    return
+            if images is False:
+                if upload is not None:
+                    upload.close()
+                return
 
-                message.images.all().delete()
+            payload, duplicate = await self.edit_message_content(room,
+                                                                 message_pk,
+                                                                 text_data_json.get('content'),
+                                                                 None if images is None else len(images),
+                                                                 client_msg_id)
 
-                for image in images:
-                    decoded_image = decode_base64_to_image(image)
-                    if decoded_image.name.split('.')[-1] not in ['jpg', 'jpeg', 'png']:
-                        return
+            if payload is None and duplicate:
+                await self.send_error(error_code.IN_PROGRESS, room, client_msg_id=client_msg_id)
+            elif payload is not None and client_msg_id is not None:
+                await self.send_ack(room, client_msg_id, payload['id'], duplicate)
 
-                    MessageImage.objects.create(author=self.scope['user'],
-                                                message=message,
-                                                image=decoded_image)
+            if payload is None or duplicate:
+                if upload is not None:
+                    upload.close()
+                return
 
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {
-                    'type': 'edit_message',
-                    'message': message_pk
-                }
-            )
+            await self.broadcast(room, 'edit_message', payload)
+
+            if images:
+                attachment_pool.spawn(self.store_attachments(room, payload['id'], images, upload))
+            elif upload is not None:
+                upload.close()
 
         elif action == 'delete':
-            message_pk = text_data_json.get('message_pk')
+            message_pk = self.get_message_pk(text_data_json)
 
-            if not message_pk:
+            if message_pk is None:
+                await self.send_error(error_code.NO_MESSAGE_PK, room)
                 return
 
-            if not Message.objects.filter(pk=message_pk).exists():
+            payload = await self.delete_message_content(room, message_pk)
+
+            if payload is None:
                 return
 
-            message = Message.objects.get(pk=message_pk)
-            message.deleted = True
-            message.save()
-
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {
-                    'type': 'delete_message',
-                    'message': message_pk
-                }
-            )
+            await self.broadcast(room, 'delete_message', payload)
 
         else:
-            self.disconnect()
+            await self.close()
+
+    # Receive message from room group
+    async def send_message(self, event):
+        # Send message to WebSocket
+        await self.send(text_data=await self.personalize(event, 'send'), kind=EVENT)
 
     # Receive message from room group
-    def send_message(self, event):
-        message = event['message']
-        serializer = WSMessageSerializer(Message.objects.get(pk=message), context={'user': self.scope['user'],
-                                                                                   'action': 'send'})
+    async def edit_message(self, event):
         # Send message to WebSocket
-        self.send(text_data=json.dumps(serializer.data))
+        await self.send(text_data=await self.personalize(event, 'edit'),
+                        kind=EDIT,
+                        key=(event['room'], event['message']['id']))
 
     # Receive message from room group
-    def edit_message(self, event):
-        message = event['message']
-        serializer = WSMessageSerializer(Message.objects.get(pk=message), context={'user': self.scope['user'],
-                                                                                   'action': 'edit'})
+    async def delete_message(self, event):
         # Send message to WebSocket
-        self.send(text_data=json.dumps(serializer.data))
+        await self.send(text_data=await self.personalize(event, 'delete'), kind=EVENT)
 
     # Receive message from room group
-    def delete_message(self, event):
-        message = event['message']
-        serializer = WSMessageSerializer(Message.objects.get(pk=message), context={'user': self.scope['user'],
-                                                                                   'action': 'delete'})
+    async def attachments_ready(self, event):
         # Send message to WebSocket
-        self.send(text_data=json.dumps(serializer.data))
+        await self.send(text_data=await self.personalize(event, 'attachments_ready'), kind=EVENT)
+
+    # Receive message from room group
+    async def message_failed(self, event):
+        # Send message to WebSocket
+        await self.send(text_data=await self.personalize(event, 'send_failed'), kind=EVENT)
+
+    # Receive typing notification from room group
+    async def typing(self, event):
+        if event['user'] == self.scope['user'].pk:
+            return
+
+        await self.send(text_data=json.dumps({'action': 'typing', 'room': event['room'], 'user': event['user']}),
+                        kind=EPHEMERAL)
+
+    # Sent by the pub/sub channel layer after its redis connection came back, events may have been lost
+    # meanwhile, so ask the client to resume every room from its last event id and reload the relationships
+    async def layer_reconnected(self, event):
+        for room in self.rooms:
+            await self.send(text_data=json.dumps({'action': 'interrupted', 'room': room}))
+
+        await db_sync_to_async(self.relationships.load)()
+
+    # Sent by friend.signals when a friend request or the friend list of the user changed
+    async def relationships_changed(self, event):
+        await db_sync_to_async(self.relationships.load)()
+
+    # Add the per-viewer fields to a shared payload
+    async def personalize(self, event, action):
+        payload = event['message']
+        frame = dict(payload)
+        author = payload['author']
+
+        if author is not None:
+            frame['author'] = dict(author, friend_type=self.relationships.friend_type(author['id']))
+
+        frame['is_mine'] = author is not None and author['id'] == self.scope['user'].pk
+        frame['action'] = action
+        frame['room'] = event['room']
+        frame['event_id'] = event.get('event_id')
+
+        return json.dumps(frame)
+
+    # Database work, grouped so each event costs at most one trip to the thread pool
+    @db_sync_to_async
+    def can_join(self, room):
+        return membership.is_member(room, self.scope['user'])
+
+    def run_once(self, action, client_msg_id, handle, *args):
+        # Returns the (payload, duplicate) of handle(*args), which remembers the message id of client_msg_id.
+        # For a client_msg_id seen before the payload is only the original's id, or None while the original
+        # is still being handled.
+        user = self.scope['user']
+
+        if client_msg_id is None:
+            return handle(*args)
+
+        if not dedup.reserve(user, action, client_msg_id):
+            message_id = dedup.get(user, action, client_msg_id)
+            return (None if message_id is None else {'id': message_id}), True
+
+        try:
+            return handle(*args)
+        except Exception:
+            # Let a retry through
+            dedup.release(user, action, client_msg_id)
+            raise
+
+    @db_sync_to_async
+    def create_message(self, room, content, image_count, client_msg_id=None):
+        # Returns (payload, duplicate), see run_once
+        if not membership.is_member(room, self.scope['user']):
+            return None, False
+
+        if not isinstance(content, str) or len(content) > Message._meta.get_field('content').max_length:
+            return None, False
+
+        return self.run_once('send', client_msg_id, self.store_message, room, content, image_count, client_msg_id)
+
+    def store_message(self, room, content, image_count, client_msg_id):
+        user = self.scope['user']
+
+        if client_msg_id is not None:
+            # Sent before the cache entry expired
+            original = self.get_original(client_msg_id)
+
+            if original is not None:
+                dedup.remember(user, 'send', client_msg_id, original)
+                return {'id': original}, True
+
+        if self.author_data is None:
+            self.author_data = WSFriendSerializer(user).data
+
+        try:
+            if message_writer.enabled:
+                message = message_writer.prepare(user, room, content, image_count, client_msg_id)
+                message_writer.enqueue(message, self.write_failed)
+            else:
+                with transaction.atomic():
+                    message = Message.objects.create(author=user, chat_room_id=room, content=content,
+                                                     pending_images=image_count, client_msg_id=client_msg_id)
+                ChatRoom.set_last_message(room, message)
+                index_message(message)
+        except IntegrityError:
+            # Sent at the same time through another process
+            original = self.get_original(client_msg_id) if client_msg_id is not None else None
+
+            if original is None:
+                raise
+
+            dedup.remember(user, 'send', client_msg_id, original)
+            return {'id': original}, True
+
+        if client_msg_id is not None:
+            dedup.remember(user, 'send', client_msg_id, message.pk)
+
+        payload = get_new_message_data(message, self.author_data)
+
+        if not message_writer.enabled:
+            # Written behind, the writer adds it to the page once the message is committed
+            hot_pages.push(room, [payload])
+
+        return payload, False
+
+    # Called from the writer thread when a message that was acked and broadcast could not be stored: let a
+    # retry through and tell the room to drop it
+    def write_failed(self, message):
+        if message.client_msg_id is not None:
+            dedup.release(self.scope['user'], 'send', message.client_msg_id)
+
+        payload = dict(error_code.WRITE_FAILED, id=message.pk, author=self.author_data)
+        asyncio.run_coroutine_threadsafe(self.broadcast(message.chat_room_id, 'message_failed', payload), self.loop)
+
+    def get_original(self, client_msg_id):
+        return Message.objects.filter(author=self.scope['user'], client_msg_id=client_msg_id) \
+                              .values_list('pk', flat=True).first()
+
+    @db_sync_to_async
+    def edit_message_content(self, room, message_pk, content, image_count, client_msg_id=None):
+        # Returns (payload, duplicate) like create_message
+        message_writer.flush()
+        message = Message.objects.filter(pk=message_pk, chat_room_id=room).first()
+
+        if message is None or message.author != self.scope['user']:
+            return None, False
+
+        if not isinstance(content, str) or len(content) > Message._meta.get_field('content').max_length:
+            return None, False
+
+        return self.run_once('edit', client_msg_id, self.update_message, message, content, image_count, client_msg_id)
+
+    def update_message(self, message, content, image_count, client_msg_id):
+        message.content = content
+        message.edited = True
+
+        if image_count is not None:
+            message.images.all().delete()
+            message.pending_images = image_count
+
+        message.save()
+        index_message(message)
+
+        if client_msg_id is not None:
+            dedup.remember(self.scope['user'], 'edit', client_msg_id, message.pk)
+
+        hot_pages.refresh(message.chat_room_id, [message.pk])
+
+        return WSMessageSerializer(message).data, False
+
+    @db_sync_to_async
+    def attach_images(self, message_pk, images):
+        message_writer.flush()
+        message = Message.objects.filter(pk=message_pk).first()
+
+        if message is None:
+            return None
+
+        with transaction.atomic():
+            stored = MessageImage.objects.bulk_create([MessageImage(author=self.scope['user'], message=message,
+                                                                    image=image, width=image.width,
+                                                                    height=image.height)
+                                                       for image in images])
+            add_references(stored_image.image.name for stored_image in stored)
+            message.pending_images = 0
+            message.save(update_fields=['pending_images'])
+
+        hot_pages.refresh(message.chat_room_id, [message.pk])
+
+        return WSMessageSerializer(message).data
+
+    @db_sync_to_async
+    def delete_message_content(self, room, message_pk):
+        message_writer.flush()
+        message = Message.objects.filter(pk=message_pk, chat_room_id=room).first()
+
+        if message is None or message.author != self.scope['user']:
+            return None
+
+        message.deleted = True
+        message.save()
+        index_message(message)
+
+        if message.chat_room.last_message_id == message.pk:
+            message.chat_room.refresh_last_message()
+
+        hot_pages.refresh(room, [message.pk])
+
+        return WSMessageSerializer(message).data
+
+
+class RoomChatConsumer(ChatConsumer):
+    # Legacy endpoint, ws/chat/<room_name>/: one socket bound to a single room
+    async def connect(self):
+        self.room_name = int(self.scope['url_route']['kwargs']['room_name'])
+        self.setup()
+
+        # Before any database work, an overloaded process should refuse sockets as cheaply as it can
+        if not await self.admit():
+            return
+
+        if not await self.can_join(self.room_name):
+            await self.refuse(close_codes.FORBIDDEN)
+            return
+
+        if await self.accept_connection():
+            await self.subscribe(self.room_name)
+
+    def get_room(self, text_data_json):
+        return self.room_name
@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.core.cache import caches
+
+PENDING = 'pending'
+
+
+class Dedup:
+    # Recently seen client_msg_ids of each author, so a retried send or edit is acknowledged with the
+    # original message instead of being written and broadcast again. Ids are reserved with an atomic
+    # add before any work is done, so concurrent retries can not both get through.
+    def __init__(self, alias, ttl):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def key(user, action, client_msg_id):
+        return f'chat-dedup:{action}:{user.pk}:{client_msg_id}'
+
+    def reserve(self, user, action, client_msg_id):
+        return self.cache.add(self.key(user, action, client_msg_id), PENDING, self.ttl)
+
+    def get(self, user, action, client_msg_id):
+        # The message id, None while the original is still being handled
+        message_id = self.cache.get(self.key(user, action, client_msg_id))
+        return None if message_id == PENDING else message_id
+
+    def remember(self, user, action, client_msg_id, message_id):
+        self.cache.set(self.key(user, action, client_msg_id), message_id, self.ttl)
+
+    def release(self, user, action, client_msg_id):
+        # The original was rejected, let a retry through
+        self.cache.delete(self.key(user, action, client_msg_id))
+
+
+dedup = Dedup(alias=settings.CHAT_DEDUP_CACHE, ttl=settings.CHAT_DEDUP_TTL)
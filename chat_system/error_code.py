@@ -19,3 +19,17 @@ CANT_REMOVE_YOURSELF = {'error_code': 'CHAT-17', 'message': 'You can not remove
 INVALID_EXTENSION = {'error_code': 'CHAT-18', 'message': 'Invalid file extension'}
 NO_PICTURE = {'error_code': 'CHAT-19', 'message': 'image is none'}
 USER_NOT_SENDER = {'error_code': 'CHAT-20', 'message': 'User is not author of the message'}
+NOT_SUBSCRIBED = {'error_code': 'CHAT-21', 'message': 'You are not subscribed to this room'}
+TOO_MANY_SUBSCRIPTIONS = {'error_code': 'CHAT-22', 'message': 'Too many rooms subscribed on one connection'}
+INVALID_UPLOAD = {'error_code': 'CHAT-23', 'message': 'Upload is invalid, too large or was aborted'}
+NO_UPLOAD = {'error_code': 'CHAT-24', 'message': 'Upload with this id does not exist or is not complete'}
+INVALID_CURSOR = {'error_code': 'CHAT-25', 'message': 'cursor is invalid'}
+LIMIT_NOT_INT = {'error_code': 'CHAT-26', 'message': 'limit is not int'}
+NO_QUERY = {'error_code': 'CHAT-27', 'message': 'q is none or empty'}
+INVALID_CLIENT_MSG_ID = {'error_code': 'CHAT-28', 'message': 'client_msg_id has to be a string of at most 64 characters'}
+RATE_LIMITED = {'error_code': 'CHAT-29', 'message': 'Too many actions or bytes, slow down'}
+NO_IMAGE = {'error_code': 'CHAT-30', 'message': 'There is no such image or thumbnail size'}
+WRITE_FAILED = {'error_code': 'CHAT-31', 'message': 'The message could not be stored, send it again'}
+IN_PROGRESS = {'error_code': 'CHAT-32', 'message': 'This client_msg_id is still being handled, wait for its ack'}
+INVALID_FRAME = {'error_code': 'CHAT-33', 'message': 'Frame is not a JSON object'}
+NO_MESSAGE_PK = {'error_code': 'CHAT-34', 'message': 'message_pk is none or not int'}
@@ -0,0 +1,170 @@
+import random
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.dateparse import parse_datetime
+from Carrier.general_functions import encode_cursor
+from friend.relations import get_friend_resolver
+from .models import Message
+from .serializer import MessageSerializer, WSMessageSerializer
+
+
+class HotPageCache:
+    # Newest messages of each room, serialized once without the viewer specific fields, so opening a room
+    # does not touch the database. Filled on the first read, then written through after every committed
+    # send/edit/delete. Pages are never changed in place: a writer takes the next version of the room with
+    # an atomic incr and stores the previous version's page with its change merged in under the new one,
+    # so two writers can not lose each other's change. A writer that finds no previous page stores
+    # nothing, the next read loads the page of the current version from the database, which holds every
+    # change with a version up to it. Versions start at a random number, a room whose version was
+    # evicted can not bring an old page back. Changes made elsewhere (e.g. a renamed author) show up once
+    # the page expires after ttl. Disabled unless alias is set, it has to name a cache every process
+    # shares (e.g. redis), or a per-process one when there is a single process.
+    def __init__(self, alias, size, ttl):
+        self.alias = alias
+        self.size = size
+        self.ttl = ttl
+
+    @property
+    def enabled(self):
+        return self.alias is not None
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def version_key(room):
+        return f'chat-hot-page-version:{room}'
+
+    @staticmethod
+    def key(room, version):
+        return f'chat-hot-page:{room}:{version}'
+
+    def get_version(self, room):
+        return self.cache.get_or_set(self.version_key(room), lambda: random.getrandbits(62), None)
+
+    @staticmethod
+    def serialize(messages):
+        return [dict(payload) for payload in WSMessageSerializer(messages, many=True).data]
+
+    def load(self, room, version):
+        messages = list(Message.objects.filter(chat_room_id=room)
+                                       .select_related('author')
+                                       .prefetch_related('images')
+                                       .order_by('-created_at', '-id')[:self.size + 1])
+
+        # complete: there are no older messages than the cached ones
+        entry = {
+            'messages': self.serialize(messages[:self.size]),
+            'complete': len(messages) <= self.size,
+        }
+        self.cache.add(self.key(room, version), entry, self.ttl)
+
+        return entry
+
+    def page(self, room, limit):
+        # Returns (payloads, more) for the newest limit messages, or None when they are not all cached
+        if not self.enabled or limit > self.size:
+            return None
+
+        version = self.get_version(room)
+        entry = self.cache.get(self.key(room, version)) or self.load(room, version)
+        messages = entry['messages']
+
+        if limit > len(messages) and not entry['complete']:
+            return None
+
+        return messages[:limit], len(messages) > limit or not entry['complete']
+
+    def push(self, room, payloads):
+        # Messages that were just committed, nobody could change them before their version is taken
+        self.write(room, lambda: payloads)
+
+    def refresh(self, room, message_ids):
+        # Changed messages are read again once the version is taken: of two edits committed at the same
+        # time, whichever takes the later version also reads the later state
+        self.write(room, lambda: self.serialize(Message.objects.filter(pk__in=message_ids)
+                                                               .select_related('author')
+                                                               .prefetch_related('images')))
+
+    def write(self, room, get_payloads):
+        if not self.enabled:
+            return
+
+        try:
+            version = self.cache.incr(self.version_key(room))
+        except ValueError:
+            # No version, so no page either
+            return
+
+        entry = self.cache.get(self.key(room, version - 1))
+
+        if entry is not None:
+            self.cache.add(self.key(room, version), self.merge(entry, get_payloads()), self.ttl)
+
+    def merge(self, entry, payloads):
+        messages = {message['id']: message for message in entry['messages']}
+        complete = entry['complete']
+        oldest = get_order(entry['messages'][-1]) if entry['messages'] else None
+
+        for payload in payloads:
+            # A message older than the page is not part of it
+            if payload['id'] in messages or complete or get_order(payload) > oldest:
+                messages[payload['id']] = payload
+
+        messages = sorted(messages.values(), key=get_order, reverse=True)
+
+        return {
+            'messages': messages[:self.size],
+            'complete': complete and len(messages) <= self.size,
+        }
+
+
+def get_order(payload):
+    return parse_datetime(payload['created_at']), payload['id']
+
+
+def personalize(payloads, request):
+    # Cached payloads as MessageSerializer would render them for request.user
+    context = {'request': request}
+    resolver = get_friend_resolver(context)
+    resolver.prime([payload['author']['id'] for payload in payloads if payload['author'] is not None])
+    messages = []
+
+    for payload in payloads:
+        message = dict(payload)
+        author = payload['author']
+
+        if author is None:
+            message['author'] = MessageSerializer.get_deleted_author(dict(context))
+        else:
+            message['author'] = dict(author,
+                                     friend_type=resolver.friend_type(author['id']),
+                                     pfp=request.build_absolute_uri(author['pfp']) if author['pfp'] else None,
+                                     pfp_variants=absolute_variant_urls(author.get('pfp_variants', {}), request))
+
+        message['images'] = [dict(image,
+                                  url=request.build_absolute_uri(image['url']),
+                                  thumbnails={size: request.build_absolute_uri(url)
+                                              for size, url in image.get('thumbnails', {}).items()})
+                             if image['url'] else image
+                             for image in payload['images']]
+        message['is_mine'] = author is not None and author['id'] == request.user.pk
+        messages.append(message)
+
+    return messages
+
+
+def absolute_variant_urls(urls, request):
+    return {size: {image_format: request.build_absolute_uri(url) for image_format, url in formats.items()}
+            for size, formats in urls.items()}
+
+
+def get_next_cursor(payloads):
+    last = payloads[-1]
+    return encode_cursor(parse_datetime(last['created_at']), last['id'])
+
+
+hot_pages = HotPageCache(alias=settings.CHAT_HOT_PAGE_CACHE,
+                         size=settings.CHAT_HOT_PAGE_SIZE,
+                         ttl=settings.CHAT_HOT_PAGE_TTL)
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from chat_system.media_gc import media_collector
+
+
+class Command(BaseCommand):
+    help = 'Delete media files nothing refers to anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-files', type=int, help='Stop after checking this many files')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be deleted')
+        parser.add_argument('--scan', action='store_true',
+                            help='Walk every media file instead of the counted ones without references, '
+                                 'resuming where the last scan stopped')
+        parser.add_argument('--restart', action='store_true', help='Start the scan over from the first file')
+
+    def handle(self, *args, **options):
+        if options['restart']:
+            media_collector.reset()
+
+        if options['scan']:
+            report = media_collector.scan(max_files=options['max_files'], dry_run=options['dry_run'])
+        else:
+            report = media_collector.run(max_files=options['max_files'], dry_run=options['dry_run'])
+
+        self.stdout.write(f"Checked {report['scanned']} files, deleted {report['deleted']}, "
+                          f"reclaimed {report['reclaimed']} bytes")
+
+        if report.get('corrected'):
+            self.stdout.write(f"Corrected the reference count of {report['corrected']} files still in use")
+
+        if not report['finished']:
+            if report['cursor']:
+                self.stdout.write('Not done yet, the next scan continues from ' + report['cursor'])
+            else:
+                self.stdout.write('Not done yet, run again for the rest')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from chat_system.models import Message
+from chat_system.search import index_message
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the message search index, e.g. for messages sent before it existed'
+
+    def handle(self, *args, **options):
+        count = 0
+
+        for message in Message.objects.iterator():
+            index_message(message)
+            count += 1
+
+        self.stdout.write(f'Indexed {count} messages')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from chat_system.models import ChatRoom
+
+
+class Command(BaseCommand):
+    help = 'Recompute ChatRoom.last_message and last_activity_at, e.g. for rooms created before they existed'
+
+    def handle(self, *args, **options):
+        count = 0
+
+        for chat_room in ChatRoom.objects.iterator():
+            chat_room.refresh_last_message()
+            count += 1
+
+        self.stdout.write(f'Refreshed {count} rooms')
@@ -0,0 +1,237 @@
+import json
+import os
+import time
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+from .media_refs import tracked
+from .models import StoredFile
+from .thumbnails import thumbnails
+
+
+class MediaCollector:
+    # Removes media files no row refers to anymore: replaced pictures, edited or deleted messages, deleted
+    # rooms and accounts. A run takes the StoredFile rows whose reference count has been 0 for longer than
+    # grace and checks them against the file fields and variant names of the rows in tracked before
+    # deleting anything, a count found off is corrected instead. A scan walks every file in name order
+    # instead, for files stored before they were counted; its position is saved after every batch, so a
+    # scan that is stopped or reaches max_files carries on from there next time. Both check batches of
+    # batch_size, at most rate files a second. Files younger than grace are kept, their row may not be
+    # committed yet (ContentAddressedStorage refreshes the mtime of a file an upload reuses).
+
+    # Names looked up in one query
+    lookup_size = 100
+
+    def __init__(self, state_file, batch_size, rate, grace):
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.rate = rate
+        self.grace = grace
+
+    @staticmethod
+    def get_directories():
+        return sorted({model._meta.get_field(field_name).upload_to.strip('/')
+                       for model, (field_name, variants_name) in tracked.items()})
+
+    @staticmethod
+    def get_defaults():
+        return {model._meta.get_field(field_name).default for model, (field_name, variants_name) in tracked.items()}
+
+    def load_state(self):
+        try:
+            with open(self.state_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'cursor': None, 'scanned': 0, 'deleted': 0, 'reclaimed': 0}
+
+    def save_state(self, state):
+        temp_path = f'{self.state_file}.part'
+
+        with open(temp_path, 'w') as f:
+            json.dump(state, f)
+
+        os.replace(temp_path, self.state_file)
+
+    def reset(self):
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def walk(self, directory, cursor):
+        # Names of the files under directory in order, skipping those up to cursor (a name split on "/")
+        try:
+            entries = sorted(os.scandir(default_storage.path(directory)), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            name = f'{directory}/{entry.name}'
+            parts = name.split('/')
+
+            if entry.is_dir(follow_symlinks=False):
+                if cursor is None or parts >= cursor[:len(parts)]:
+                    yield from self.walk(name, cursor)
+            elif entry.is_file(follow_symlinks=False) and (cursor is None or parts > cursor):
+                yield name
+
+    def get_references(self, names):
+        # How many rows use each of names, counted like media_refs does, names no row uses are left out.
+        # Variant names are only found inside JSON, rows are picked by a substring match on each name and
+        # their names compared exactly.
+        references = Counter()
+
+        for model, (field_name, variants_name) in tracked.items():
+            directory = model._meta.get_field(field_name).upload_to.strip('/') + '/'
+            model_names = sorted(name for name in set(names) if name.startswith(directory))
+            fields = [field_name] if variants_name is None else [field_name, variants_name]
+
+            for start in range(0, len(model_names), self.lookup_size):
+                lookup = set(model_names[start:start + self.lookup_size])
+                query = Q(**{f'{field_name}__in': lookup})
+
+                if variants_name is not None:
+                    for name in lookup:
+                        query |= Q(**{f'{variants_name}__icontains': name})
+
+                for row in model.objects.filter(query).values_list(*fields):
+                    used = {row[0]}
+
+                    if variants_name is not None:
+                        used.update(name for formats in (row[1] or {}).values() for name in formats.values())
+
+                    references.update(used & lookup)
+
+        return references
+
+    def collect(self, batch, dry_run):
+        # Returns (deleted, reclaimed bytes) of a batch
+        live = set(self.get_references(batch)) | self.get_defaults()
+
+        return self.remove([name for name in batch if name not in live], dry_run)
+
+    def remove(self, names, dry_run):
+        # Deletes the files of names nobody uses, and their StoredFile rows unless they got a reference
+        # meanwhile. Returns (deleted, reclaimed bytes).
+        now = time.time()
+        deleted = []
+        missing = []
+        reclaimed = 0
+
+        for name in names:
+            path = default_storage.path(name)
+
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                missing.append(name)
+                continue
+
+            if now - stat.st_mtime < self.grace:
+                continue
+
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+
+                for size in thumbnails.sizes:
+                    if os.path.exists(thumbnails.path(name, size)):
+                        os.remove(thumbnails.path(name, size))
+
+            deleted.append(name)
+            reclaimed += stat.st_size
+
+        if (deleted or missing) and not dry_run:
+            StoredFile.objects.filter(name__in=deleted + missing, references=0).delete()
+
+        return len(deleted), reclaimed
+
+    def run(self, max_files=None, dry_run=False):
+        # Returns the totals of the files without references, whether all of them were checked and how
+        # many counts were corrected. A dry run deletes and corrects nothing.
+        cutoff = timezone.now() - timedelta(seconds=self.grace)
+        report = {'scanned': 0, 'deleted': 0, 'reclaimed': 0, 'corrected': 0, 'cursor': None, 'finished': False}
+        last_pk = 0
+
+        while max_files is None or report['scanned'] < max_files:
+            started = time.monotonic()
+            size = self.batch_size if max_files is None else min(self.batch_size, max_files - report['scanned'])
+            candidates = list(StoredFile.objects.filter(references=0, updated_at__lt=cutoff, pk__gt=last_pk)
+                                                .order_by('pk')
+                                                .values_list('pk', 'name')[:size])
+
+            if not candidates:
+                report['finished'] = True
+                break
+
+            last_pk = candidates[-1][0]
+            names = [name for pk, name in candidates]
+            references = self.get_references(names)
+            live = set(references) | self.get_defaults()
+
+            if not dry_run:
+                # Counts that went off, e.g. rows changed with update(), which sends no signals
+                for name, count in references.items():
+                    report['corrected'] += StoredFile.objects.filter(name=name, references=0).update(references=count)
+
+            deleted, reclaimed = self.remove([name for name in names if name not in live], dry_run)
+            report['scanned'] += len(names)
+            report['deleted'] += deleted
+            report['reclaimed'] += reclaimed
+
+            time.sleep(max(0, len(names) / self.rate - (time.monotonic() - started)))
+
+        return report
+
+    def scan(self, max_files=None, dry_run=False):
+        # Returns the totals of the pass so far and whether it went through every file. A dry run deletes
+        # nothing and leaves the saved position alone.
+        state = self.load_state()
+        cursor = state['cursor'].split('/') if state['cursor'] else None
+        files = (name for directory in self.get_directories() for name in self.walk(directory, cursor))
+        scanned = 0
+        finished = False
+
+        while True:
+            started = time.monotonic()
+            batch = []
+
+            for name in files:
+                batch.append(name)
+
+                if len(batch) >= self.batch_size or (max_files is not None and scanned + len(batch) >= max_files):
+                    break
+
+            if not batch:
+                finished = True
+                break
+
+            deleted, reclaimed = self.collect(batch, dry_run)
+            scanned += len(batch)
+            state = dict(state,
+                         cursor=batch[-1],
+                         scanned=state['scanned'] + len(batch),
+                         deleted=state['deleted'] + deleted,
+                         reclaimed=state['reclaimed'] + reclaimed)
+
+            if not dry_run:
+                self.save_state(state)
+
+            if max_files is not None and scanned >= max_files:
+                break
+
+            time.sleep(max(0, len(batch) / self.rate - (time.monotonic() - started)))
+
+        if finished and not dry_run:
+            self.reset()
+
+        return dict(state, finished=finished)
+
+
+media_collector = MediaCollector(state_file=settings.MEDIA_GC_STATE_FILE,
+                                 batch_size=settings.MEDIA_GC_BATCH,
+                                 rate=settings.MEDIA_GC_RATE,
+                                 grace=settings.MEDIA_GC_GRACE)
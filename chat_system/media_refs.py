@@ -0,0 +1,64 @@
+from collections import Counter
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.utils import timezone
+from .models import ChatRoom, MessageImage, StoredFile
+
+# Models using stored files: (file field, JSON field of variant names or None)
+tracked = {
+    MessageImage: ('image', None),
+    ChatRoom: ('image', 'image_variants'),
+    get_user_model(): ('pfp', 'pfp_variants'),
+}
+
+
+def get_media_names(instance):
+    # Names of the stored files instance uses, None when they are not loaded. Field defaults are static
+    # pictures, not stored files.
+    field_name, variants_name = tracked[type(instance)]
+    deferred = instance.get_deferred_fields()
+
+    if field_name in deferred or variants_name in deferred:
+        return None
+
+    default = instance._meta.get_field(field_name).default
+    names = [getattr(instance, field_name).name]
+
+    if variants_name is not None:
+        names += [name for formats in (getattr(instance, variants_name) or {}).values() for name in formats.values()]
+
+    return {name for name in names if name and name != default}
+
+
+def update_references(names, change):
+    now = timezone.now()
+    counts = Counter(names)
+
+    if change > 0:
+        StoredFile.objects.bulk_create([StoredFile(name=name, updated_at=now) for name in counts], ignore_conflicts=True)
+
+    # One update per distinct count, usually just one
+    for count in set(counts.values()):
+        group = [name for name, name_count in counts.items() if name_count == count]
+        files = StoredFile.objects.filter(name__in=group)
+
+        if change > 0:
+            files.update(references=F('references') + count, updated_at=now)
+        else:
+            files.filter(references__gte=count).update(references=F('references') - count, updated_at=now)
+            files.filter(references__lt=count).update(references=0, updated_at=now)
+
+
+def add_references(names):
+    # names may repeat, e.g. the same picture attached twice to one message
+    names = list(names)
+
+    if names:
+        update_references(names, 1)
+
+
+def remove_references(names):
+    names = list(names)
+
+    if names:
+        update_references(names, -1)
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from Carrier.versioned_cache import VersionedCache
+from .models import ChatRoom
+
+
+def _pk(obj):
+    pk = getattr(obj, 'pk', obj)
+    return None if pk is None else int(pk)
+
+
+class MembershipIndex:
+    # Answers "is this user a member / admin of this room" with one indexed existence query, cached per
+    # (room, user). Other processes see a removal once their entry expires (ttl), unless
+    # CHAT_MEMBERSHIP_CACHE names a shared cache (e.g. redis), see Carrier.versioned_cache.
+    def __init__(self, max_size, ttl, shared_cache=None):
+        self.cache = VersionedCache('chat-membership', max_size, ttl, shared_cache)
+
+    @staticmethod
+    def query(room_id, user_id):
+        users = ChatRoom.users.through.objects.filter(chatroom_id=OuterRef('pk'), customuser_id=user_id)
+        creators = ChatRoom.creators.through.objects.filter(chatroom_id=OuterRef('pk'), customuser_id=user_id)
+
+        roles = ChatRoom.objects.filter(pk=room_id).annotate(
+            is_member=Exists(users), is_admin=Exists(creators)).values_list('is_member', 'is_admin').first()
+
+        return roles or (False, False)
+
+    def roles(self, room, user):
+        room_id, user_id = _pk(room), _pk(user)
+
+        if room_id is None or user_id is None:
+            return False, False
+
+        roles = self.cache.get(room_id, user_id)
+
+        if roles is None:
+            roles = tuple(self.query(room_id, user_id))
+            self.cache.set(room_id, user_id, roles)
+
+        return tuple(roles)
+
+    def is_member(self, room, user):
+        return self.roles(room, user)[0]
+
+    def is_admin(self, room, user):
+        return self.roles(room, user)[1]
+
+    def invalidate(self, room, users=None):
+        self.cache.invalidate(_pk(room), None if users is None else [_pk(user) for user in users])
+
+
+membership = MembershipIndex(max_size=settings.CHAT_MEMBERSHIP_CACHE_SIZE,
+                             ttl=settings.CHAT_MEMBERSHIP_CACHE_TTL,
+                             shared_cache=settings.CHAT_MEMBERSHIP_CACHE)
@@ -1,39 +1,76 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
 
 class ChatRoom(models.Model):
     creators = models.ManyToManyField(get_user_model(), related_name='my_groups')
     image = models.ImageField(upload_to="chatrooms/", default="chatrooms/default.png")
+    # Storage names of the resized copies of image, {size: {format: name}}, see user.imgs
+    image_variants = models.JSONField(default=dict, blank=True)
     users = models.ManyToManyField(get_user_model(), related_name='chatrooms')
     name = models.CharField(max_length=75, blank=False)
+    # Maintained by ChatConsumer so the room list is a single ordered query
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_activity_at = models.DateTimeField(null=True, blank=True)
 
-    @property
-    def last_message(self):
-        if len(self.messages.all()) == 0:
-            return None
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity_at', '-id'], name='chatroom_activity_idx'),
+        ]
+
+    def refresh_last_message(self):
+        self.last_message = self.messages.filter(deleted=False).order_by('-created_at', '-id').first()
+
+        if self.last_activity_at is None and self.last_message is not None:
+            self.last_activity_at = self.last_message.created_at
 
-        return self.messages.all().order_by('-created_at').first()
+        self.save(update_fields=['last_message', 'last_activity_at'])
+
+    @staticmethod
+    def set_last_message(room_id, message):
+        # Only ever moves forward, concurrent senders can finish out of order
+        ChatRoom.objects.filter(models.Q(last_activity_at__isnull=True) | models.Q(last_activity_at__lte=message.created_at),
+                                pk=room_id).update(last_message=message, last_activity_at=message.created_at)
 
     def connect_user(self, user):
-        if user not in self.users.all():
-            self.user.add(user)
+        if not self.is_user_in_chat_room(user):
+            self.users.add(user)
             self.save()
 
     def disconnect(self, user):
-        if user in self.users.all():
+        if self.is_user_in_chat_room(user):
             self.users.remove(user)
             self.save()
 
     def is_user_in_chat_room(self, user):
-        x = user in self.users.all()
-        return x
+        from .membership import membership
+        return membership.is_member(self, user)
+
+    def is_user_admin(self, user):
+        from .membership import membership
+        return membership.is_admin(self, user)
 
     @staticmethod
     def get_group_by_user(user):
         groups = ChatRoom.objects.filter(users__in=[user])
         return groups
 
+    @staticmethod
+    def get_ordered_groups_by_user(user):
+        return ChatRoom.get_group_by_user(user).order_by(models.F('last_activity_at').desc(nulls_last=True), '-id')
+
+    def annotate_user_flags(self, users):
+        # is_member, is_admin and is_invited for a whole user queryset, computed by the database
+        return users.annotate(
+            is_member=models.Exists(ChatRoom.users.through.objects.filter(chatroom_id=self.pk,
+                                                                          customuser_id=models.OuterRef('pk'))),
+            is_admin=models.Exists(ChatRoom.creators.through.objects.filter(chatroom_id=self.pk,
+                                                                            customuser_id=models.OuterRef('pk'))),
+            is_invited=models.Exists(ChatroomInvitation.objects.filter(chatroom_id=self.pk,
+                                                                       receiver_id=models.OuterRef('pk'))),
+        )
+
     @property
     def group_name(self):
         return f'PublicChatRoom-{self.id}'
@@ -46,12 +83,25 @@ class Message(models.Model):
     author = models.ForeignKey(get_user_model(), on_delete=models.SET_NULL, null=True)
     chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='messages', max_length=2000)
     content = models.TextField(max_length=2000, blank=False, null=False)
-    created_at = models.DateTimeField(auto_now=True)
+    # Not auto_now_add, the write-behind writer sets it before the message is saved
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     deleted = models.BooleanField(default=False)
     edited = models.BooleanField(default=False)
+    pending_images = models.PositiveSmallIntegerField(default=0)
+    # Chosen by the client so a resent message is not stored twice
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
 
     max_images = 100
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['author', 'client_msg_id'], name='unique_author_client_msg_id'),
+        ]
+        indexes = [
+            # History is paged by (created_at, id) cursors within a room
+            models.Index(fields=['chat_room', 'created_at', 'id'], name='message_room_created_idx'),
+        ]
+
     def __str__(self):
         return self.content
 
@@ -60,11 +110,35 @@ class MessageImage(models.Model):
     author = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to="messages/")
+    # Set from the processed upload, so clients can lay out images before loading them
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
 
     def __str__(self):
         return self.image.url
 
 
+class MessageTerm(models.Model):
+    # Inverted index over Message.content, maintained by chat_system.search. Room and time are copied
+    # from the message so a search is a single ordered index range scan.
+    term = models.CharField(max_length=32)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='terms')
+    chat_room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'term'], name='unique_message_term'),
+        ]
+        indexes = [
+            models.Index(fields=['chat_room', 'term', 'created_at', 'message'], name='message_term_room_idx'),
+            models.Index(fields=['term', 'created_at', 'message'], name='message_term_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.term} -> {self.message_id}'
+
+
 class ChatroomInvitation(models.Model):
     chatroom = models.ForeignKey(ChatRoom, related_name='invitations', on_delete=models.CASCADE)
     sender = models.ForeignKey(get_user_model(), related_name='chatroom_invitation_from_me', on_delete=models.CASCADE)
@@ -80,3 +154,14 @@ class ChatroomInvitation(models.Model):
     def accept(self):
         self.chatroom.users.add(self.receiver)
         self.delete()
+
+
+class StoredFile(models.Model):
+    # How many rows use a content addressed media file (Carrier.storage), kept by chat_system.media_refs.
+    # Files left without references are removed by the media garbage collector.
+    name = models.CharField(max_length=255, unique=True)
+    references = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.name} ({self.references})'
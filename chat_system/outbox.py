@@ -0,0 +1,173 @@
+import asyncio
+import json
+from collections import deque
+from twisted.internet.abstract import FileDescriptor
+from . import close_codes
+
+# Kinds of frames, in the order they are given up when a client falls behind
+EPHEMERAL = 'ephemeral'
+EDIT = 'edit'
+EVENT = 'event'
+CONTROL = 'control'
+
+
+class Outbox:
+    # Frames waiting to be written to one websocket. Group handlers only queue, a writer task drains the
+    # queue, so a slow client never holds up its consumer and the channel layer never drops silently.
+    # When the queue is full the policies are applied in order:
+    #   coalesce_edits  a newer edit of a message replaces the queued one (always, not only when full)
+    #   drop_ephemeral  typing notifications are dropped, new ones first
+    # and if that is not enough the queue is discarded, the client gets a resync frame and is disconnected.
+    # Writing never blocks under daphne, Twisted buffers whatever it is given. So while more than
+    # transport_buffer bytes are waiting in the transport of the connection, frames stay queued and the
+    # writer checks again every poll_interval. Servers whose send waits for the client (e.g. uvicorn) hold
+    # up the writer task instead.
+    poll_interval = 0.05
+    depth = 0
+    counters = {
+        'queued': 0,
+        'sent': 0,
+        'stalls': 0,
+        'coalesced': 0,
+        'dropped': 0,
+        'overflows': 0,
+        'max_depth': 0,
+    }
+
+    def __init__(self, write, close, size, policies, transport_buffer):
+        self.write = write
+        self.close = close
+        self.size = size
+        self.policies = policies
+        self.transport_buffer = transport_buffer
+        self.transport = None
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.task = None
+
+    @classmethod
+    def count(cls, name, amount=1):
+        cls.counters[name] += amount
+
+    @classmethod
+    def stats(cls):
+        return dict(cls.counters, depth=cls.depth)
+
+    def start(self, transport=None):
+        # transport: of the daphne connection, see get_transport
+        self.transport = transport
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+        Outbox.depth -= len(self.frames)
+        self.frames.clear()
+
+    def remove(self, index):
+        del self.frames[index]
+        Outbox.depth -= 1
+
+    def put(self, text, kind=CONTROL, key=None):
+        if self.closing:
+            return
+
+        if kind == EDIT and key is not None and 'coalesce_edits' in self.policies:
+            for index, frame in enumerate(self.frames):
+                if frame[0] == EDIT and frame[1] == key:
+                    # Moved to the back, frames keep the order of their event ids
+                    self.remove(index)
+                    self.count('coalesced')
+                    break
+
+        if len(self.frames) >= self.size and 'drop_ephemeral' in self.policies:
+            if kind == EPHEMERAL:
+                self.count('dropped')
+                return
+
+            for index, frame in enumerate(self.frames):
+                if frame[0] == EPHEMERAL:
+                    self.remove(index)
+                    self.count('dropped')
+                    break
+
+        if len(self.frames) >= self.size:
+            self.overflow()
+            return
+
+        self.frames.append((kind, key, text))
+        Outbox.depth += 1
+        self.count('queued')
+        Outbox.counters['max_depth'] = max(Outbox.counters['max_depth'], len(self.frames))
+        self.ready.set()
+
+    def overflow(self):
+        self.count('overflows')
+        self.count('dropped', len(self.frames))
+        Outbox.depth -= len(self.frames)
+        self.frames.clear()
+
+        # Whatever was lost has to be refetched, or resumed from the last event id the client has seen
+        self.frames.append((CONTROL, None, json.dumps({'action': 'resync', 'room': None})))
+        Outbox.depth += 1
+        self.closing = True
+        self.ready.set()
+
+    def is_stalled(self):
+        return self.transport is not None and get_buffered(self.transport) > self.transport_buffer
+
+    async def run(self):
+        while True:
+            stalled = False
+
+            while self.frames:
+                if not self.closing and self.is_stalled():
+                    # The client is not reading, the frames wait here where the policies apply to them.
+                    # The resync frame of a closing outbox goes out regardless.
+                    if not stalled:
+                        stalled = True
+                        self.count('stalls')
+
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                stalled = False
+                kind, key, text = self.frames.popleft()
+                Outbox.depth -= 1
+
+                try:
+                    await self.write(text)
+                except Exception:
+                    # The socket is gone, disconnect() stops the outbox
+                    return
+
+                self.count('sent')
+
+            if self.closing:
+                await self.close(code=close_codes.SLOW_CONSUMER)
+                return
+
+            self.ready.clear()
+            await self.ready.wait()
+
+
+def get_transport(send):
+    # The socket transport of the daphne connection behind the send callable the server gave the
+    # application, daphne makes it with functools.partial(server.handle_reply, protocol). None under
+    # other servers.
+    args = getattr(send, 'args', ())
+    transport = getattr(args[0], 'transport', None) if args else None
+
+    # The websocket protocol writes through the HTTP channel it was upgraded from
+    while transport is not None and not isinstance(transport, FileDescriptor):
+        transport = getattr(transport, 'transport', None)
+
+    return transport
+
+
+def get_buffered(transport):
+    # Bytes written to a Twisted socket transport that the kernel has not taken yet
+    return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
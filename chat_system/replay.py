@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import uuid
+import aioredis
+from collections import OrderedDict, deque
+from threading import Lock
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RoomLog:
+    def __init__(self, size):
+        # Ids are "<token>:<seq>", a new token every time the log is (re)created so stale ids never match
+        self.token = uuid.uuid4().hex[:12]
+        self.sequence = 0
+        self.events = deque(maxlen=size)
+
+
+class LocalReplayBuffer:
+    # Recent events of each room in this process, a bounded ring per room and at most max_rooms rooms.
+    # Only events sent from this process are recorded, so it suits a single process deployment or
+    # serves as the fallback when redis is unreachable.
+    def __init__(self, size, max_rooms):
+        self.size = size
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()
+        self.lock = Lock()
+
+    def append(self, room, event):
+        with self.lock:
+            log = self.rooms.get(room)
+
+            if log is None:
+                log = self.rooms[room] = RoomLog(self.size)
+
+            self.rooms.move_to_end(room)
+
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+
+            log.sequence += 1
+            event_id = f'{log.token}:{log.sequence}'
+            log.events.append((log.sequence, dict(event, event_id=event_id)))
+
+        return event_id
+
+    def since(self, room, event_id):
+        token, _, sequence = event_id.partition(':')
+
+        try:
+            sequence = int(sequence)
+        except ValueError:
+            return None
+
+        with self.lock:
+            log = self.rooms.get(room)
+
+            if log is None or log.token != token or sequence > log.sequence:
+                return None
+
+            # Events right after event_id have been pushed out of the ring
+            if log.events and log.events[0][0] > sequence + 1:
+                return None
+
+            return [event for event_sequence, event in log.events if event_sequence > sequence]
+
+
+class RedisReplayBuffer:
+    # One capped redis stream per room, shared by every process. Stream ids ("<ms>-<seq>") are the event ids.
+    connect_timeout = 1
+
+    def __init__(self, address, size, ttl, fallback):
+        self.address = address
+        self.size = size
+        self.ttl = ttl
+        self.fallback = fallback
+        self.pools = {}
+
+    async def get_redis(self):
+        # Connections belong to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        pool = self.pools.get(loop)
+
+        if pool is None:
+            pool = await aioredis.create_redis_pool(self.address, encoding='utf-8', timeout=self.connect_timeout)
+            self.pools[loop] = pool
+
+        return pool
+
+    @staticmethod
+    def key(room):
+        return f'chat-replay:{room}'
+
+    @staticmethod
+    def parse_id(event_id):
+        try:
+            ms, sequence = event_id.split('-')
+            return int(ms), int(sequence)
+        except (AttributeError, ValueError):
+            return None
+
+    async def append(self, room, event):
+        try:
+            redis = await self.get_redis()
+            transaction = redis.multi_exec()
+            event_id = transaction.xadd(self.key(room), {'event': json.dumps(event)}, max_len=self.size)
+            transaction.expire(self.key(room), self.ttl)
+            await transaction.execute()
+            event_id = await event_id
+        except (OSError, asyncio.TimeoutError, aioredis.RedisError) as e:
+            logger.warning('Replay stream unavailable, recording locally: %s', e)
+            return self.fallback.append(room, event)
+
+        return event_id
+
+    async def since(self, room, event_id):
+        if self.parse_id(event_id) is None:
+            return self.fallback.since(room, event_id)
+
+        try:
+            redis = await self.get_redis()
+            pipe = redis.pipeline()
+            oldest = pipe.xrange(self.key(room), count=1)
+            entries = pipe.xrange(self.key(room), start=event_id, count=self.size + 1)
+            await pipe.execute()
+            oldest, entries = await oldest, await entries
+        except (OSError, asyncio.TimeoutError, aioredis.RedisError) as e:
+            logger.warning('Replay stream unavailable: %s', e)
+            return None
+
+        # Trimming is approximate, the buffer holds the delta only if nothing after event_id was trimmed
+        if not oldest or self.parse_id(oldest[0][0]) > self.parse_id(event_id):
+            return None
+
+        return [dict(json.loads(fields['event']), event_id=entry_id)
+                for entry_id, fields in entries if entry_id != event_id]
+
+
+class ReplayBuffer:
+    # Log of the recent send/edit/delete events of every room, so a reconnecting client can ask for what
+    # it missed since its last seen event id. A redis stream when CHAT_REPLAY_REDIS is set, otherwise a
+    # per-process ring.
+    def __init__(self):
+        self.backend = None
+
+    def get_backend(self):
+        if self.backend is None:
+            local = LocalReplayBuffer(settings.CHAT_REPLAY_SIZE, settings.CHAT_REPLAY_ROOMS)
+
+            if settings.CHAT_REPLAY_REDIS:
+                self.backend = RedisReplayBuffer(settings.CHAT_REPLAY_REDIS, settings.CHAT_REPLAY_SIZE,
+                                                 settings.CHAT_REPLAY_TTL, local)
+            else:
+                self.backend = local
+
+        return self.backend
+
+    async def append(self, room, event):
+        # Returns the id of the recorded event
+        backend = self.get_backend()
+
+        if isinstance(backend, LocalReplayBuffer):
+            return backend.append(room, event)
+
+        return await backend.append(room, event)
+
+    async def since(self, room, event_id):
+        # Events after event_id, oldest first, or None when the client has to refetch the history
+        if not isinstance(event_id, str) or not event_id:
+            return None
+
+        backend = self.get_backend()
+
+        if isinstance(backend, LocalReplayBuffer):
+            return backend.since(room, event_id)
+
+        return await backend.since(room, event_id)
+
+
+replay_buffer = ReplayBuffer()
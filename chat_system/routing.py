@@ -1,7 +1,8 @@
 from django.urls import re_path
 
-from .consumers import ChatConsumer
+from .consumers import ChatConsumer, RoomChatConsumer
 
 websocket_urlpatterns = [
-    re_path(r'ws/chat/(?P<room_name>\w+)/$', ChatConsumer.as_asgi()),
+    re_path(r'ws/chat/$', ChatConsumer.as_asgi()),
+    re_path(r'ws/chat/(?P<room_name>\d+)/$', RoomChatConsumer.as_asgi()),
 ]
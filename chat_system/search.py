@@ -0,0 +1,77 @@
+import re
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from auth_system.search import normalize, tokenize
+from .models import ChatRoom, Message, MessageTerm
+
+MAX_TERM_LENGTH = MessageTerm._meta.get_field('term').max_length
+SNIPPET_RADIUS = 60
+
+
+def get_terms(text):
+    return list(dict.fromkeys(tokenize(text, MAX_TERM_LENGTH)))
+
+
+def get_message_terms(message):
+    # Soft deleted messages have no terms and so are never found
+    if message.deleted:
+        return []
+
+    return [MessageTerm(term=term, message_id=message.pk, chat_room_id=message.chat_room_id, created_at=message.created_at)
+            for term in get_terms(message.content)]
+
+
+@transaction.atomic
+def index_message(message):
+    # Called on every send/edit/delete
+    MessageTerm.objects.filter(message=message).delete()
+    MessageTerm.objects.bulk_create(get_message_terms(message))
+
+
+def search_messages(query, user, room=None, cursor=None, limit=50):
+    # Messages containing every word of query, newest first, in room or in all of the user's rooms.
+    # The longest word drives a range scan of the term index in (created_at, id) order, the other words
+    # are checked per candidate, so a page costs the same however long the room history is.
+    # cursor is the decoded (created_at, pk) of the last hit of the previous page. Returns (messages, more).
+    words = get_terms(query)
+
+    if not words:
+        return [], False
+
+    driver = max(words, key=len)
+    terms = MessageTerm.objects.filter(term=driver)
+
+    if room is not None:
+        terms = terms.filter(chat_room_id=room)
+    else:
+        terms = terms.filter(chat_room_id__in=ChatRoom.users.through.objects.filter(customuser_id=user.pk)
+                                                                         .values('chatroom_id'))
+
+    for word in words:
+        if word != driver:
+            terms = terms.filter(Exists(MessageTerm.objects.filter(message_id=OuterRef('message_id'), term=word)))
+
+    if cursor is not None:
+        created_at, pk = cursor
+        terms = terms.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, message_id__lt=pk))
+
+    message_ids = list(terms.order_by('-created_at', '-message_id').values_list('message_id', flat=True)[:limit + 1])
+    messages = Message.objects.select_related('author').prefetch_related('images').in_bulk(message_ids[:limit])
+
+    return [messages[pk] for pk in message_ids[:limit] if pk in messages], len(message_ids) > limit
+
+
+def get_snippet(content, query):
+    # Part of content around the first word matching the query
+    words = set(get_terms(query))
+    start = 0
+
+    for match in re.finditer(r'[^\W_]+', content):
+        if normalize(match.group())[:MAX_TERM_LENGTH] in words:
+            start = match.start()
+            break
+
+    begin = max(0, start - SNIPPET_RADIUS)
+    end = min(len(content), start + SNIPPET_RADIUS)
+
+    return f"{'…' if begin > 0 else ''}{content[begin:end]}{'…' if end < len(content) else ''}"
@@ -1,8 +1,10 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 from .models import ChatRoom, Message, ChatroomInvitation, MessageImage
-from friend.serializer import FriendSerializer
-from friend.models import FriendRequest
+from friend.serializer import FriendSerializer, FriendTypeListSerializer
+from .search import get_snippet
+from .thumbnails import thumbnails
+from user.imgs import ImageVariantsField
 
 
 class ChatroomUserSerializer(FriendSerializer):
@@ -16,20 +18,27 @@ class ChatroomUserSerializer(FriendSerializer):
                   'last_name',
                   'full_name',
                   'pfp',
+                  'pfp_variants',
                   'friends',
                   'is_admin']
 
     def get_is_admin(self, user):
+        admin_ids = self.context.get('admin_ids')
+        if admin_ids is not None:
+            return user.pk in admin_ids
+
         chatroom = self.context.get('chatroom')
-        return user in chatroom.creators.all()
+        return chatroom.is_user_admin(user)
 
 
+# Expects users annotated by ChatRoom.annotate_user_flags
 class ChatroomUserSearchSerializer(serializers.ModelSerializer):
     full_name = serializers.ReadOnlyField()
-    is_invited = serializers.SerializerMethodField()
-    is_member = serializers.SerializerMethodField()
-    is_admin = serializers.SerializerMethodField()
+    is_invited = serializers.BooleanField(read_only=True)
+    is_member = serializers.BooleanField(read_only=True)
+    is_admin = serializers.BooleanField(read_only=True)
     is_me = serializers.SerializerMethodField()
+    pfp_variants = ImageVariantsField()
 
     class Meta:
         model = get_user_model()
@@ -39,23 +48,12 @@ class ChatroomUserSearchSerializer(serializers.ModelSerializer):
                   'last_name',
                   'full_name',
                   'pfp',
+                  'pfp_variants',
                   'is_invited',
                   'is_member',
                   'is_admin',
                   'is_me']
 
-    def get_is_invited(self, user):
-        chatroom = self.context.get('chatroom')
-        return ChatroomInvitation.objects.filter(chatroom=chatroom, receiver=user).exists()
-
-    def get_is_member(self, user):
-        chatroom = self.context.get('chatroom')
-        return user in chatroom.users.all()
-
-    def get_is_admin(self, user):
-        chatroom = self.context.get('chatroom')
-        return user in chatroom.creators.all()
-
     def get_is_me(self, user):
         request = self.context.get('request')
         return request.user == user
@@ -63,10 +61,20 @@ class ChatroomUserSearchSerializer(serializers.ModelSerializer):
 
 class MessageImageSerializer(serializers.ModelSerializer):
     url = serializers.ImageField(use_url=True, source='image')
+    thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = MessageImage
-        fields = ['url']
+        fields = ['url', 'width', 'height', 'thumbnails']
+
+    def get_thumbnails(self, image):
+        request = self.context.get('request')
+        urls = thumbnails.get_urls(image.image.name)
+
+        if request is None:
+            return urls
+
+        return {size: request.build_absolute_uri(url) for size, url in urls.items()}
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -78,6 +86,11 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = ['id', 'author', 'content', 'created_at', 'is_mine', 'images', 'deleted', 'edited']
+        list_serializer_class = FriendTypeListSerializer
+
+    @staticmethod
+    def get_friend_type_ids(messages):
+        return [message.author_id for message in messages]
 
     def get_content(self, message):
         if message.deleted:
@@ -89,17 +102,20 @@ class MessageSerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         return request is not None and request.user == message.author
 
+    @staticmethod
+    def get_deleted_author(context):
+        default_user = get_user_model()()
+        default_user.pk = 0
+        default_user.first_name = 'Deleted'
+        default_user.last_name = 'Account'
+        default_user.username = 'DeletedAccount'
+
+        context['skip'] = True
+        return FriendSerializer(default_user, context=context).data
+
     def get_author(self, message):
         if message.author is None:
-            default_user = get_user_model()()
-            default_user.pk = 0
-            default_user.first_name = 'Deleted'
-            default_user.last_name = 'Account'
-            default_user.username = 'DeletedAccount'
-
-            context = self.context
-            context['skip'] = True
-            return FriendSerializer(default_user, context=context).data
+            return self.get_deleted_author(self.context)
 
         return FriendSerializer(message.author, context=self.context).data
 
@@ -107,12 +123,28 @@ class MessageSerializer(serializers.ModelSerializer):
         if message.deleted:
             return []
 
-        return MessageImageSerializer(message.images, many=True, read_only=True, context=self.context).data
+        images = MessageImageSerializer(message.images, many=True, read_only=True, context=self.context).data
+
+        # Attachments still being processed in the background
+        return images + [{'url': None, 'status': 'processing'}] * message.pending_images
+
+
+class MessageSearchSerializer(MessageSerializer):
+    room = serializers.IntegerField(source='chat_room_id', read_only=True)
+    snippet = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Message
+        fields = ['id', 'room', 'author', 'content', 'snippet', 'created_at', 'is_mine', 'images', 'edited']
+        list_serializer_class = FriendTypeListSerializer
+
+    def get_snippet(self, message):
+        return get_snippet(message.content, self.context.get('query', ''))
 
 
 class WSFriendSerializer(serializers.ModelSerializer):
     full_name = serializers.ReadOnlyField()
-    friend_type = serializers.SerializerMethodField()
+    pfp_variants = ImageVariantsField()
 
     class Meta:
         model = get_user_model()
@@ -121,38 +153,35 @@ class WSFriendSerializer(serializers.ModelSerializer):
                   'first_name',
                   'last_name',
                   'full_name',
-                  'friend_type',
-                  'pfp']
-
-    def get_friend_type(self, user):
-        request_user = self.context.get('user')
-        if not request_user.is_authenticated:
-            return "none"
-
-        if FriendRequest.objects.filter(sender=user, receiver=request_user).exists():
-            return "requested"
-        elif FriendRequest.objects.filter(sender=request_user, receiver=user).exists():
-            return "invited"
-        elif request_user.friend_list.is_friend(user):
-            return "friend"
-        else:
-            return "none"
+                  'pfp',
+                  'pfp_variants']
 
 
+# Viewer independent payload, built once per event and broadcast to the whole room.
+# Consumers add is_mine, friend_type and action per connection.
 class WSMessageSerializer(MessageSerializer):
     author = WSFriendSerializer()
-    action = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ['id', 'author', 'content', 'created_at', 'is_mine', 'images', 'deleted', 'edited', 'action']
+        fields = ['id', 'author', 'content', 'created_at', 'images', 'deleted', 'edited']
+
+
+created_at_field = serializers.DateTimeField()
 
-    def get_is_mine(self, message):
-        user = self.context.get('user')
-        return user is not None and user == message.author
 
-    def get_action(self, message):
-        return self.context.get('action')
+def get_new_message_data(message, author):
+    # WSMessageSerializer(message).data for a message that was just created, without setting up the
+    # serializer's fields for every message. author is the WSFriendSerializer data of message.author
+    return {
+        'id': message.pk,
+        'author': author,
+        'content': message.content,
+        'created_at': created_at_field.to_representation(message.created_at),
+        'images': [{'url': None, 'status': 'processing'}] * message.pending_images,
+        'deleted': False,
+        'edited': False,
+    }
 
 
 class GroupSerializer(serializers.ModelSerializer):
@@ -160,30 +189,42 @@ class GroupSerializer(serializers.ModelSerializer):
     creators = serializers.SerializerMethodField()
     is_admin = serializers.SerializerMethodField()
     last_message = MessageSerializer(allow_null=True)
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = ChatRoom
         fields = '__all__'
+        list_serializer_class = FriendTypeListSerializer
+
+    @staticmethod
+    def get_friend_type_ids(groups):
+        # Members are listed without friend_type, only the last message authors have one
+        return [group.last_message.author_id for group in groups if group.last_message is not None]
 
     def get_is_admin(self, group):
         request = self.context.get('request')
-        return request is not None and request.user in group.creators.all()
+        return request is not None and group.is_user_admin(request.user)
 
-    def get_users(self, group):
-        context = {'chatroom': group}
+    def get_members_context(self, group):
+        context = {'chatroom': group, 'admin_ids': {creator.pk for creator in group.creators.all()}}
         context.update(self.context)
+        return context
+
+    def get_users(self, group):
+        context = self.get_members_context(group)
         return ChatroomUserSerializer(group.users.all(), many=True, read_only=True, context=context).data
 
     def get_creators(self, group):
-        context = {'chatroom': group}
-        context.update(self.context)
+        context = self.get_members_context(group)
         return ChatroomUserSerializer(group.creators.all(), many=True, read_only=True, context=context).data
 
 
 class SilentGroupSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = ChatRoom
-        fields = ['id', 'name', 'image']
+        fields = ['id', 'name', 'image', 'image_variants']
 
 
 class ChatRoomInvitationSerializer(serializers.ModelSerializer):
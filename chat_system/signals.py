@@ -0,0 +1,60 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+from django.dispatch import receiver
+from .models import ChatRoom, MessageImage
+from .membership import membership
+from .media_refs import get_media_names, add_references, remove_references
+
+
+@receiver(m2m_changed, sender=ChatRoom.users.through)
+@receiver(m2m_changed, sender=ChatRoom.creators.through)
+def invalidate_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # The rooms a user is being removed from are only known before the clear happens
+        for room_id in sender.objects.filter(customuser_id=instance.pk).values_list('chatroom_id', flat=True):
+            membership.invalidate(room_id, [instance.pk])
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        membership.invalidate(instance.pk, pk_set)
+    elif pk_set:
+        for room_id in pk_set:
+            membership.invalidate(room_id, [instance.pk])
+
+
+@receiver(post_delete, sender=ChatRoom)
+def forget_deleted_room(sender, instance, **kwargs):
+    membership.invalidate(instance.pk)
+
+
+# Reference counts of stored media files, see chat_system.media_refs. bulk_create sends no post_save,
+# its callers add the references themselves.
+@receiver(post_init, sender=MessageImage)
+@receiver(post_init, sender=ChatRoom)
+@receiver(post_init, sender=get_user_model())
+def remember_media_names(sender, instance, **kwargs):
+    instance._media_names = set() if instance.pk is None else get_media_names(instance)
+
+
+@receiver(post_save, sender=MessageImage)
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_save, sender=get_user_model())
+def count_media_references(sender, instance, created, **kwargs):
+    old = set() if created else instance._media_names
+    new = get_media_names(instance)
+
+    if old is None or new is None:
+        return
+
+    add_references(new - old)
+    remove_references(old - new)
+    instance._media_names = new
+
+
+@receiver(post_delete, sender=MessageImage)
+@receiver(post_delete, sender=ChatRoom)
+@receiver(post_delete, sender=get_user_model())
+def release_media_references(sender, instance, **kwargs):
+    remove_references(get_media_names(instance) or ())
@@ -1,3 +1,539 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from functools import partial
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.http import http_date
+from twisted.internet.abstract import FileDescriptor
+from Carrier.general_functions import decode_cursor, encode_cursor
+from Carrier.media import get_range, serve_file
+from Carrier.versioned_cache import VersionedCache
+from . import close_codes, error_code
+from .consumers import ChatConsumer
+from .hot_page import HotPageCache
+from .models import ChatRoom, Message, MessageTerm
+from .outbox import Outbox, EPHEMERAL, EDIT, EVENT, get_buffered, get_transport
+from .replay import LocalReplayBuffer
+from .search import get_snippet, get_terms
+from .throttle import ConnectionThrottle, TokenBucket
+from .writer import MessageWriter
 
-# Create your tests here.
+
+# The writer closes stale connections of its own thread, here it runs on the test's connection
+@mock.patch('chat_system.writer.close_old_connections', mock.Mock())
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='writer', first_name='Writer', last_name='Test',
+                                                         email='writer@example.com', password='pw12345678')
+        self.room = ChatRoom.objects.create(name='room')
+        self.writer = MessageWriter(enabled=True, interval=0, batch_size=10, worker_id=1)
+
+    def prepare(self, content):
+        return self.writer.prepare(self.user, self.room.pk, content, 0)
+
+    def test_batch(self):
+        messages = [self.prepare(f'hello {i}') for i in range(3)]
+        on_failure = mock.Mock()
+
+        self.writer.write([(message, on_failure) for message in messages])
+
+        self.assertEqual(Message.objects.filter(chat_room=self.room).count(), 3)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, messages[-1].pk)
+        self.assertEqual(MessageTerm.objects.filter(term='hello').count(), 3)
+        on_failure.assert_not_called()
+
+    def test_failed_message_is_reported(self):
+        message = self.prepare('first')
+        # Same id, as made by another process with the same writer id
+        duplicate = Message(pk=message.pk, author=self.user, chat_room_id=self.room.pk, content='second')
+        on_written, on_failure = mock.Mock(), mock.Mock()
+
+        with self.assertLogs('chat_system.writer', 'ERROR'):
+            self.writer.write([(message, on_written), (duplicate, on_failure)])
+
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['first'])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, message.pk)
+        on_written.assert_not_called()
+        on_failure.assert_called_once_with(duplicate)
+
+    def test_failing_callback(self):
+        message = self.prepare('first')
+        duplicate = Message(pk=message.pk, author=self.user, chat_room_id=self.room.pk, content='second')
+
+        with self.assertLogs('chat_system.writer', 'ERROR'):
+            self.writer.write([(message, None), (duplicate, mock.Mock(side_effect=RuntimeError))])
+
+        self.assertEqual(Message.objects.count(), 1)
+
+
+class HotPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username='hot', first_name='Hot', last_name='Page',
+                                                         email='hot@example.com', password='pw12345678')
+        self.room = ChatRoom.objects.create(name='room')
+        self.hot_pages = HotPageCache('default', size=3, ttl=60)
+
+    def send(self, content):
+        message = Message.objects.create(author=self.user, chat_room=self.room, content=content)
+        self.hot_pages.refresh(self.room.pk, [message.pk])
+        return message
+
+    def contents(self):
+        messages, more = self.hot_pages.page(self.room.pk, 3)
+        return [message['content'] for message in messages], more
+
+    def test_written_through(self):
+        self.send('first')
+        self.assertEqual(self.contents(), (['first'], False))
+
+        message = self.send('second')
+        message.content = 'edited'
+        message.save()
+        self.hot_pages.refresh(self.room.pk, [message.pk])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.contents(), (['edited', 'first'], False))
+
+        for content in ('third', 'fourth'):
+            self.send(content)
+
+        self.assertEqual(self.contents(), (['fourth', 'third', 'edited'], True))
+
+    def test_older_message_is_not_added(self):
+        first = self.send('first')
+
+        for content in ('second', 'third', 'fourth'):
+            self.send(content)
+
+        self.contents()
+        self.hot_pages.refresh(self.room.pk, [first.pk])
+        self.assertEqual(self.contents(), (['fourth', 'third', 'second'], True))
+
+    def test_concurrent_writers(self):
+        self.contents()
+        first = Message.objects.create(author=self.user, chat_room=self.room, content='first')
+        second = Message.objects.create(author=self.user, chat_room=self.room, content='second')
+
+        # The second writer takes its version while the first one is still merging its message in
+        def get_first():
+            self.hot_pages.refresh(self.room.pk, [second.pk])
+            return self.hot_pages.serialize([first])
+
+        self.hot_pages.write(self.room.pk, get_first)
+        self.assertEqual(self.contents(), (['second', 'first'], False))
+
+
+class VersionedCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_local(self):
+        entries = VersionedCache('test', max_size=2, ttl=60)
+        entries.set(1, 'a', 'first')
+        entries.set(1, 'b', 'second')
+        entries.get(1, 'a')
+        entries.set(2, 'a', 'third')
+
+        # b was used least recently
+        self.assertEqual((entries.get(1, 'a'), entries.get(1, 'b'), entries.get(2, 'a')), ('first', None, 'third'))
+
+        entries.invalidate(1)
+        self.assertEqual((entries.get(1, 'a'), entries.get(2, 'a')), (None, 'third'))
+
+        entries.set(2, 'b', 'expired', ttl=-1)
+        self.assertIsNone(entries.get(2, 'b'))
+
+    def test_shared(self):
+        entries = VersionedCache('test', max_size=2, ttl=60, shared_cache='default')
+
+        for item in 'abc':
+            entries.set(1, item, item)
+
+        entries.set(2, 'a', 'other')
+        self.assertIsNone(entries.peek(1, 'a'))
+        self.assertEqual(entries.get(1, 'c'), 'c')
+
+        entries.invalidate(1, ['a'])
+        self.assertEqual((entries.get(1, 'a'), entries.get(1, 'b')), (None, 'b'))
+
+        entries.invalidate(1)
+        self.assertEqual((entries.get(1, 'b'), entries.get(2, 'a')), (None, 'other'))
+
+        # A group whose version was evicted gets a new one, not the old values
+        cache.delete(entries.version_key(2))
+        self.assertIsNone(entries.get(2, 'a'))
+
+
+class OutboxTests(SimpleTestCase):
+    # A client that stopped reading: the transport keeps what it was given and frames pile up in the outbox
+    def setUp(self):
+        self.written = []
+        self.close = mock.AsyncMock()
+        self.transport = FileDescriptor(reactor=mock.Mock())
+
+    async def write(self, text):
+        self.written.append(text)
+
+    def stall(self, stalled=True):
+        self.transport._tempDataLen = 2048 if stalled else 0
+
+    async def start(self, size=4):
+        outbox = Outbox(self.write, self.close, size, ['coalesce_edits', 'drop_ephemeral'], transport_buffer=1024)
+        outbox.poll_interval = 0
+        outbox.start(self.transport)
+        self.stall()
+        return outbox
+
+    async def drain(self, outbox):
+        self.stall(False)
+
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+        outbox.stop()
+
+    async def test_stalled_frames_are_sent_later(self):
+        outbox = await self.start()
+        outbox.put('a', EVENT)
+        outbox.put('b', EVENT)
+
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+        self.assertEqual(self.written, [])
+        await self.drain(outbox)
+        self.assertEqual(self.written, ['a', 'b'])
+
+    async def test_coalesce_edits(self):
+        outbox = await self.start()
+        outbox.put('edit 1', EDIT, key=(1, 10))
+        outbox.put('event', EVENT)
+        outbox.put('edit 2', EDIT, key=(1, 10))
+        outbox.put('other edit', EDIT, key=(1, 11))
+
+        await self.drain(outbox)
+        self.assertEqual(self.written, ['event', 'edit 2', 'other edit'])
+
+    async def test_drop_ephemeral(self):
+        outbox = await self.start(size=2)
+        outbox.put('typing 1', EPHEMERAL)
+        outbox.put('event 1', EVENT)
+        # Full: the queued typing frame makes room, then a new one is not queued at all
+        outbox.put('event 2', EVENT)
+        outbox.put('typing 2', EPHEMERAL)
+
+        await self.drain(outbox)
+        self.assertEqual(self.written, ['event 1', 'event 2'])
+        self.close.assert_not_called()
+
+    async def test_overflow_closes(self):
+        outbox = await self.start(size=2)
+
+        for index in range(3):
+            outbox.put(f'event {index}', EVENT)
+
+        # Still stalled, the resync frame goes out regardless and the socket is closed
+        await asyncio.sleep(0)
+        self.assertEqual([json.loads(text) for text in self.written], [{'action': 'resync', 'room': None}])
+        self.close.assert_awaited_once_with(code=close_codes.SLOW_CONSUMER)
+
+        outbox.put('event 3', EVENT)
+        self.assertEqual(len(self.written), 1)
+        outbox.stop()
+
+    def test_get_transport(self):
+        async def handle_reply(protocol, message):
+            pass
+
+        # daphne's websocket protocol writes to the HTTP channel, which writes to the socket
+        protocol = mock.Mock(spec=['transport'], transport=mock.Mock(spec=['transport'], transport=self.transport))
+
+        self.assertIs(get_transport(partial(handle_reply, protocol)), self.transport)
+        self.assertIsNone(get_transport(handle_reply))
+        self.assertEqual(get_buffered(self.transport), 0)
+        self.stall()
+        self.assertEqual(get_buffered(self.transport), 2048)
+
+
+@override_settings(CHAT_CONNECTION_ACTION_RATE=(0, 2), CHAT_USER_ACTION_RATE=(0, 100), CHAT_RATE_MAX_VIOLATIONS=2)
+class ConsumerThrottleTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {'user': mock.Mock(pk='throttle-test')}
+        self.consumer.upload = None
+        self.consumer.send_error = mock.AsyncMock()
+        self.consumer.close = mock.AsyncMock()
+        self.consumer.throttle = ConnectionThrottle(self.consumer.scope['user'])
+        self.consumer.throttle.open()
+
+    def tearDown(self):
+        self.consumer.throttle.close()
+        ConnectionThrottle.users.pop('throttle-test', None)
+
+    async def test_binary_frame_without_upload_is_charged(self):
+        for _ in range(4):
+            await self.consumer.receive(bytes_data=b'x')
+
+        errors = [call.args[0] for call in self.consumer.send_error.await_args_list]
+        self.assertEqual(errors, [error_code.INVALID_UPLOAD, error_code.INVALID_UPLOAD, error_code.RATE_LIMITED])
+        self.consumer.close.assert_awaited_once_with(code=close_codes.RATE_LIMITED)
+
+    async def test_text_frames_are_charged(self):
+        for _ in range(3):
+            await self.consumer.receive(text_data=json.dumps({'action': 'typing'}))
+
+        errors = [call.args[0] for call in self.consumer.send_error.await_args_list]
+        self.assertEqual(errors[-1], error_code.RATE_LIMITED)
+        self.consumer.close.assert_not_awaited()
+
+    @override_settings(CHAT_MAX_CONNECTIONS=0)
+    async def test_refused_connection(self):
+        self.consumer.refuse = mock.AsyncMock()
+
+        self.assertFalse(await self.consumer.admit())
+        self.consumer.refuse.assert_awaited_once_with(close_codes.OVERLOADED)
+
+
+class ThrottleTests(SimpleTestCase):
+    def tearDown(self):
+        ConnectionThrottle.users.clear()
+
+    @mock.patch('chat_system.throttle.time.monotonic')
+    def test_token_bucket(self, monotonic):
+        monotonic.return_value = 100
+        bucket = TokenBucket(rate=2, burst=3)
+
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        self.assertFalse(bucket.take(2))
+
+        monotonic.return_value = 101
+        self.assertTrue(bucket.take(2))
+        self.assertFalse(bucket.take())
+
+        # Never more than burst saved up
+        monotonic.return_value = 200
+        self.assertFalse(bucket.take(4))
+        self.assertTrue(bucket.take(3))
+
+    @override_settings(CHAT_MAX_CONNECTIONS=2, CHAT_MAX_USER_CONNECTIONS=1)
+    def test_admit(self):
+        user, other = mock.Mock(pk='admit-1'), mock.Mock(pk='admit-2')
+        refused = ConnectionThrottle.counters['refused_connections']
+
+        self.assertIsNone(ConnectionThrottle.admit(user, 0))
+        throttle = ConnectionThrottle(user)
+        throttle.open()
+
+        self.assertEqual(ConnectionThrottle.admit(user, 1), close_codes.TOO_MANY_CONNECTIONS)
+        self.assertIsNone(ConnectionThrottle.admit(other, 1))
+        self.assertEqual(ConnectionThrottle.admit(other, 2), close_codes.OVERLOADED)
+        self.assertEqual(ConnectionThrottle.counters['refused_connections'], refused + 2)
+
+        throttle.close()
+        self.assertIsNone(ConnectionThrottle.admit(user, 1))
+
+    @override_settings(CHAT_CONNECTION_ACTION_RATE=(0, 10), CHAT_USER_ACTION_RATE=(0, 3),
+                       CHAT_RATE_MAX_VIOLATIONS=2)
+    def test_user_allowance_is_shared(self):
+        user = mock.Mock(pk='shared')
+        first, second = ConnectionThrottle(user), ConnectionThrottle(user)
+        first.open()
+        second.open()
+
+        self.assertEqual([first.allow_action(), second.allow_action(), first.allow_action()], [True, True, True])
+        self.assertFalse(second.allow_action())
+        self.assertFalse(second.exhausted)
+        self.assertFalse(second.allow_action())
+        self.assertTrue(second.exhausted)
+        self.assertFalse(first.exhausted)
+
+    @override_settings(CHAT_CONNECTION_UPLOAD_RATE=(0, 100), CHAT_USER_UPLOAD_RATE=(0, 1000))
+    def test_allow_bytes(self):
+        throttle = ConnectionThrottle(mock.Mock(pk='bytes'))
+        throttle.open()
+        rejected = ConnectionThrottle.counters['rejected_bytes']
+
+        self.assertTrue(throttle.allow_bytes(60))
+        self.assertFalse(throttle.allow_bytes(60))
+        self.assertEqual(ConnectionThrottle.counters['rejected_bytes'], rejected + 1)
+        self.assertTrue(throttle.allow_bytes(40))
+        self.assertEqual(throttle.violations, 0)
+
+    @override_settings(CHAT_THROTTLE_USERS=1)
+    def test_idle_users_are_forgotten(self):
+        idle = ConnectionThrottle(mock.Mock(pk='idle'))
+        idle.open()
+        idle.close()
+
+        ConnectionThrottle(mock.Mock(pk='active')).open()
+        self.assertEqual(list(ConnectionThrottle.users), ['active'])
+
+
+class ReplayBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = LocalReplayBuffer(size=3, max_rooms=2)
+
+    def append(self, room, count):
+        return [self.buffer.append(room, {'type': 'send', 'index': index}) for index in range(count)]
+
+    def test_since(self):
+        ids = self.append(1, 3)
+
+        self.assertEqual(len({event_id.partition(':')[0] for event_id in ids}), 1)
+        self.assertEqual([event['index'] for event in self.buffer.since(1, ids[0])], [1, 2])
+        self.assertEqual([event['event_id'] for event in self.buffer.since(1, ids[0])], ids[1:])
+        self.assertEqual(self.buffer.since(1, ids[-1]), [])
+
+    def test_resync(self):
+        ids = self.append(1, 5)
+
+        # The events right after the first two were pushed out of the ring
+        self.assertIsNone(self.buffer.since(1, ids[0]))
+        self.assertEqual([event['index'] for event in self.buffer.since(1, ids[1])], [2, 3, 4])
+
+        token = ids[0].partition(':')[0]
+        for event_id in ['other:1', f'{token}:x', f'{token}:9', '1-0']:
+            self.assertIsNone(self.buffer.since(1, event_id))
+
+        self.assertIsNone(self.buffer.since(2, ids[1]))
+
+    def test_evicted_room(self):
+        first = self.append(1, 1)[0]
+        self.append(2, 1)
+        self.append(3, 1)
+
+        self.assertIsNone(self.buffer.since(1, first))
+
+        # A new log for the room, ids of the old one never match it
+        second = self.append(1, 1)[0]
+        self.assertNotEqual(first.partition(':')[0], second.partition(':')[0])
+        self.assertIsNone(self.buffer.since(1, first))
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip(self):
+        created_at = datetime(2021, 11, 3, 12, 30, 15, 250, tzinfo=timezone.utc)
+
+        self.assertEqual(decode_cursor(encode_cursor(created_at, 42)), (created_at, 42))
+
+    def test_invalid(self):
+        for cursor in ['', 'not a cursor', '%%%', encode_cursor(datetime(2021, 1, 1), 1)[:-4],
+                       'MjAyMS0wMS0wMQ==', 'eHx5']:
+            self.assertIsNone(decode_cursor(cursor), cursor)
+
+
+class MediaRangeTests(SimpleTestCase):
+    etag = '"64-1"'
+    mtime = 1000000000
+    size = 100
+
+    def get_range(self, header=None, if_range=None):
+        headers = {}
+
+        if header is not None:
+            headers['HTTP_RANGE'] = header
+
+        if if_range is not None:
+            headers['HTTP_IF_RANGE'] = if_range
+
+        return get_range(RequestFactory().get('/', **headers), self.etag, self.mtime, self.size)
+
+    def test_ranges(self):
+        self.assertIsNone(self.get_range())
+        self.assertEqual(self.get_range('bytes=0-9'), (0, 9))
+        self.assertEqual(self.get_range('bytes=90-'), (90, 99))
+        self.assertEqual(self.get_range('bytes=0-500'), (0, 99))
+        self.assertEqual(self.get_range('bytes=-10'), (90, 99))
+        self.assertEqual(self.get_range('bytes=-200'), (0, 99))
+
+    def test_whole_file(self):
+        for header in ['bytes=5-2', 'bytes=0-1,5-6', 'items=0-1', 'bytes=-']:
+            self.assertIsNone(self.get_range(header), header)
+
+    def test_not_satisfiable(self):
+        self.assertIs(self.get_range('bytes=100-'), False)
+        self.assertIs(self.get_range('bytes=-0'), False)
+
+    def test_if_range(self):
+        self.assertEqual(self.get_range('bytes=0-9', self.etag), (0, 9))
+        self.assertEqual(self.get_range('bytes=0-9', http_date(self.mtime)), (0, 9))
+        self.assertIsNone(self.get_range('bytes=0-9', '"other"'))
+        self.assertIsNone(self.get_range('bytes=0-9', http_date(self.mtime - 60)))
+
+
+@override_settings(MEDIA_SENDFILE=None)
+class ServeFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.path = os.path.join(self.root, 'file.bin')
+
+        with open(self.path, 'wb') as f:
+            f.write(bytes(range(100)))
+
+    def get(self, **headers):
+        return serve_file(RequestFactory().get('/', **headers), self.path)
+
+    def test_partial(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+    def test_not_satisfiable(self):
+        response = self.get(HTTP_RANGE='bytes=200-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_stale_if_range(self):
+        response = self.get(HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"other"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(b''.join(response.streaming_content)), 100)
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_offload(self):
+        with self.settings(MEDIA_SENDFILE='x-accel-redirect', MEDIA_ACCEL_LOCATIONS={self.root: '/internal/'}):
+            response = self.get(HTTP_RANGE='bytes=10-19')
+
+        # Ranges are left to the front server too
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/internal/file.bin')
+        self.assertEqual(response.content, b'')
+
+
+class SearchTextTests(SimpleTestCase):
+    def test_get_terms(self):
+        self.assertEqual(get_terms('Héllo, WORLD! hello_there  Straße 42'),
+                         ['hello', 'world', 'there', 'strasse', '42'])
+        self.assertEqual(get_terms('  ...  '), [])
+
+    def test_long_terms_are_cut(self):
+        term = get_terms('a' * 500)[0]
+
+        self.assertEqual(term, 'a' * len(term))
+        self.assertLess(len(term), 500)
+
+    def test_snippet(self):
+        content = 'x' * 100 + ' Needle ' + 'y' * 100
+        snippet = get_snippet(content, 'néedle')
+
+        self.assertTrue(snippet.startswith('…') and snippet.endswith('…'))
+        self.assertIn(' Needle ', snippet)
+        self.assertEqual(get_snippet('short text', 'text'), 'short text')
+        self.assertEqual(get_snippet(content, 'missing'), content[:60] + '…')
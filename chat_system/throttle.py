@@ -0,0 +1,103 @@
+import time
+from django.conf import settings
+from . import close_codes
+
+
+class TokenBucket:
+    # rate tokens a second, at most burst saved up
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if amount > self.tokens:
+            return False
+
+        self.tokens -= amount
+        return True
+
+
+class UserAllowance:
+    # Shared by every socket of one user in this process
+    def __init__(self):
+        self.connections = 0
+        self.actions = TokenBucket(*settings.CHAT_USER_ACTION_RATE)
+        self.bytes = TokenBucket(*settings.CHAT_USER_UPLOAD_RATE)
+
+
+class ConnectionThrottle:
+    # Admission of new sockets and token buckets on actions and attachment bytes, for the socket and for
+    # its user across sockets. Limits are per process, like the sockets themselves.
+    users = {}
+    counters = {
+        'refused_connections': 0,
+        'rejected_actions': 0,
+        'rejected_bytes': 0,
+        'rate_limit_closes': 0,
+    }
+
+    def __init__(self, user):
+        self.user_id = user.pk
+        self.actions = TokenBucket(*settings.CHAT_CONNECTION_ACTION_RATE)
+        self.bytes = TokenBucket(*settings.CHAT_CONNECTION_UPLOAD_RATE)
+        self.allowance = None
+        self.violations = 0
+
+    @classmethod
+    def stats(cls):
+        return dict(cls.counters, users=len(cls.users))
+
+    @classmethod
+    def admit(cls, user, connections):
+        # Close code refusing a new socket, or None
+        allowance = cls.users.get(user.pk)
+
+        if connections >= settings.CHAT_MAX_CONNECTIONS:
+            code = close_codes.OVERLOADED
+        elif allowance is not None and allowance.connections >= settings.CHAT_MAX_USER_CONNECTIONS:
+            code = close_codes.TOO_MANY_CONNECTIONS
+        else:
+            return None
+
+        cls.counters['refused_connections'] += 1
+        return code
+
+    def open(self):
+        if self.user_id not in self.users and len(self.users) >= settings.CHAT_THROTTLE_USERS:
+            # Users without sockets only keep their buckets while there is room for them
+            for user_id in [user_id for user_id, allowance in self.users.items() if not allowance.connections]:
+                del self.users[user_id]
+
+        self.allowance = self.users.setdefault(self.user_id, UserAllowance())
+        self.allowance.connections += 1
+
+    def close(self):
+        if self.allowance is not None:
+            self.allowance.connections -= 1
+            self.allowance = None
+
+    def allow(self, granted, counter):
+        if granted:
+            self.violations = 0
+        else:
+            self.violations += 1
+            self.counters[counter] += 1
+
+        return granted
+
+    def allow_action(self):
+        return self.allow(self.actions.take() and self.allowance.actions.take(), 'rejected_actions')
+
+    def allow_bytes(self, amount):
+        return self.allow(self.bytes.take(amount) and self.allowance.bytes.take(amount), 'rejected_bytes')
+
+    @property
+    def exhausted(self):
+        # Kept on going after being told to slow down
+        return self.violations >= settings.CHAT_RATE_MAX_VIOLATIONS
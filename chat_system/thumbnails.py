@@ -0,0 +1,139 @@
+import mimetypes
+import os
+import tempfile
+import time
+from threading import Lock
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image
+
+
+class ThumbnailCache:
+    # Downscaled copies of message images, made on the first request for a size and kept on disk under
+    # root. The least recently used ones (file mtime, refreshed on use at most every touch_interval) are
+    # removed once the cache grows past max_bytes.
+    touch_interval = 60 * 60
+    upload_to = 'messages/'
+
+    def __init__(self, root, max_bytes, sizes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sizes = sizes
+        self.size = None
+        self.lock = Lock()
+
+    def is_valid_name(self, name):
+        return (name.startswith(self.upload_to) and not os.path.isabs(name)
+                and '..' not in name.split('/') and '\\' not in name)
+
+    def path(self, name, size):
+        return os.path.join(self.root, str(size), name)
+
+    def get(self, name, size):
+        # Path of the thumbnail of the message image stored as name, None when there is no such image
+        if size not in self.sizes or not self.is_valid_name(name):
+            return None
+
+        path = self.path(name, size)
+
+        try:
+            if time.time() - os.path.getmtime(path) > self.touch_interval:
+                os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        try:
+            source = default_storage.open(name)
+        except (FileNotFoundError, SuspiciousFileOperation):
+            return None
+
+        with source:
+            nbytes = self.make(source, size, path)
+
+        self.add(nbytes, path)
+        return path
+
+    @staticmethod
+    def make(source, size, path):
+        # Fits the image in a size x size box, never enlarging it. Returns the size of the file.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with Image.open(source) as img:
+            image_format = 'PNG' if img.format == 'PNG' else 'JPEG'
+            img.thumbnail((size, size), Image.LANCZOS)
+
+            if image_format == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+
+            # Written aside and moved into place, a concurrent request never reads half a file
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    img.save(f, format=image_format, quality=settings.IMAGE_VARIANT_QUALITY)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+        return os.path.getsize(path)
+
+    def scan(self):
+        entries = []
+
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                path = os.path.join(directory, file)
+
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        return entries
+
+    def add(self, nbytes, path):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(entry[1] for entry in self.scan())
+            else:
+                self.size += nbytes
+
+            if self.size > self.max_bytes:
+                self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # Down to 90% of max_bytes, so not every new thumbnail starts an eviction. keep is the one about to
+        # be served.
+        entries = sorted(self.scan())
+        self.size = sum(entry[1] for entry in entries)
+
+        for mtime, nbytes, path in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self.size -= nbytes
+
+    @staticmethod
+    def content_type(name):
+        return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    def get_urls(self, name):
+        return {str(size): reverse('message-thumbnail', kwargs={'size': size, 'name': name}) for size in self.sizes}
+
+
+thumbnails = ThumbnailCache(root=settings.CHAT_THUMBNAIL_ROOT,
+                            max_bytes=settings.CHAT_THUMBNAIL_CACHE_SIZE,
+                            sizes=settings.CHAT_THUMBNAIL_SIZES)
@@ -0,0 +1,68 @@
+import uuid
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from .base64 import get_file_extension
+from .models import Message
+
+
+class Upload:
+    # Attachments streamed over a websocket as binary frames. Sizes are declared up front and enforced
+    # chunk by chunk, every chunk goes straight to a temporary file, so memory use stays at one chunk
+    # no matter how many or how large the images are.
+    allowed_extensions = ['jpg', 'jpeg', 'png']
+
+    def __init__(self, sizes):
+        self.id = uuid.uuid4().hex
+        self.sizes = sizes
+        self.files = []
+        self.received = 0
+
+    @classmethod
+    def validate_sizes(cls, attachments):
+        if not isinstance(attachments, list) or not 0 < len(attachments) <= Message.max_images:
+            return None
+
+        sizes = []
+        for attachment in attachments:
+            size = attachment.get('size') if isinstance(attachment, dict) else None
+
+            if not isinstance(size, int) or not 0 < size <= settings.CHAT_MAX_ATTACHMENT_SIZE:
+                return None
+
+            sizes.append(size)
+
+        return sizes
+
+    @property
+    def complete(self):
+        return len(self.files) == len(self.sizes) and self.received == self.sizes[-1]
+
+    def write(self, chunk):
+        if self.complete or len(chunk) > settings.CHAT_UPLOAD_CHUNK_SIZE:
+            return False
+
+        if not self.files or self.received == self.sizes[len(self.files) - 1]:
+            # First chunk of the next attachment, sniff its type before storing anything
+            extension = get_file_extension(None, chunk)
+            if extension not in self.allowed_extensions:
+                return False
+
+            size = self.sizes[len(self.files)]
+            self.files.append(TemporaryUploadedFile(f'upload.{extension}',
+                                                    f'image/{extension}', size, None))
+            self.received = 0
+
+        if self.received + len(chunk) > self.sizes[len(self.files) - 1]:
+            return False
+
+        self.files[-1].write(chunk)
+        self.received += len(chunk)
+
+        if self.received == self.sizes[len(self.files) - 1]:
+            self.files[-1].seek(0)
+
+        return True
+
+    def close(self):
+        for file in self.files:
+            file.close()
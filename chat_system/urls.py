@@ -6,6 +6,8 @@ urlpatterns = [
     path('create/', CreateRoom.as_view()),
     path('get-user-groups/', GetUserChatRooms.as_view()),
     path('<int:room_pk>/get-messages/', GetChatRoomMessages.as_view()),
+    path('<int:room_pk>/search-messages/', SearchMessages.as_view()),
+    path('search-messages/', SearchMessages.as_view()),
     path('invitations-to-me/', InvitesToMe.as_view()),
     path('<int:chatroom_pk>/', GetChatRoomInfo.as_view()),
     path('<int:chatroom_pk>/invite/', InviteUser.as_view()),
@@ -19,5 +21,7 @@ urlpatterns = [
     path('<int:chatroom_pk>/remove-admin/', DeleteAdmin.as_view()),
     path('<int:chatroom_pk>/delete/', DeleteChatRoom.as_view()),
     path('<int:chatroom_pk>/add-picture/', AddChatRoomPicture.as_view()),
-    path('<int:chatroom_pk>/edit/', EditChatRoom.as_view())
+    path('<int:chatroom_pk>/edit/', EditChatRoom.as_view()),
+    path('worker-stats/', GetWorkerStats.as_view()),
+    path('thumbnails/<int:size>/<path:name>', GetMessageThumbnail.as_view(), name='message-thumbnail'),
 ]
@@ -1,34 +1,38 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Value, Q
-from django.db.models.functions import Concat
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
-import uuid
 from PIL import Image
-from itertools import chain
-from Carrier.general_functions import validate_offset_and_limit
+from Carrier.media import serve_file
+from Carrier.general_functions import validate_offset_and_limit, encode_cursor, decode_cursor
+from Carrier.threadpool import db_executor
+from auth_system.search import search_users
 from . import error_code
+from .consumers import ChatConsumer
+from .outbox import Outbox
+from .throttle import ConnectionThrottle
 from .models import ChatRoom, Message, ChatroomInvitation
-from .serializer import GroupSerializer, MessageSerializer, ChatRoomInvitationSerializer, ChatroomUserSearchSerializer
-from user.imgs import cut
+from .search import search_messages
+from .hot_page import hot_pages, personalize, get_next_cursor
+from .thumbnails import thumbnails
+from .serializer import GroupSerializer, MessageSerializer, ChatRoomInvitationSerializer, ChatroomUserSearchSerializer, \
+    MessageSearchSerializer
+from user.imgs import cut, save_variants
 
 
 class GetUserChatRooms(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        user = request.user
-        not_none_chats = filter(
-            lambda chat: True if chat.last_message is not None else False, ChatRoom.get_group_by_user(user=user)
-        )
-        none_chats = filter(
-            lambda chat: False if chat.last_message is not None else True, ChatRoom.get_group_by_user(user=user)
-        )
-        groups = reversed(sorted(not_none_chats,  key=lambda chat: chat.last_message.created_at))
-        all_groups = list(chain(groups, none_chats))
-        serializer = GroupSerializer(all_groups, many=True, context={'request': request})
+        offset, limit = validate_offset_and_limit(request)
+
+        groups = ChatRoom.get_ordered_groups_by_user(user=request.user).select_related(
+            'last_message__author').prefetch_related('last_message__images', 'users__friends', 'creators__friends')[offset:limit]
+
+        serializer = GroupSerializer(groups, many=True, context={'request': request})
         return Response(serializer.data)
 
 
@@ -38,9 +42,12 @@ class GetChatRoomMessages(APIView):
     def get(self, request, room_pk):
         group = get_object_or_404(ChatRoom, pk=room_pk)
 
-        if request.user not in group.users.all():
+        if not group.is_user_in_chat_room(request.user):
             return Response(error_code.USER_NOT_MEMBER, status=401)
 
+        if request.GET.get('cursor') is not None:
+            return self.get_page(request, group)
+
         offset, limit = validate_offset_and_limit(request)
 
         if request.GET.get('last_message') is not None:
@@ -53,9 +60,17 @@ class GetChatRoomMessages(APIView):
                 return Response(error_code.NO_LAST_MESSAGE, status=400)
 
             last_message = get_object_or_404(Message, pk=last_message)
-            qs = group.messages.filter(created_at__lte=last_message.created_at).order_by('-created_at')[offset:limit]
+            qs = group.messages.filter(created_at__lte=last_message.created_at)
         else:
-            qs = group.messages.all().order_by('-created_at')[offset:limit]
+            # Newest page, served from the hot page cache when it holds all of it
+            page = hot_pages.page(group.pk, limit) if not offset and limit is not None else None
+
+            if page is not None:
+                return Response(personalize(page[0], request))
+
+            qs = group.messages.all()
+
+        qs = qs.select_related('author').prefetch_related('images').order_by('-created_at', '-id')[offset:limit]
 
         serializer = MessageSerializer(qs,
                                        many=True,
@@ -64,14 +79,95 @@ class GetChatRoomMessages(APIView):
 
         return Response(serializer.data)
 
+    # ?cursor=<next_cursor of the previous page>, empty for the newest page
+    def get_page(self, request, group):
+        try:
+            limit = int(request.GET.get('limit') or settings.CHAT_MESSAGES_PAGE_SIZE)
+        except ValueError:
+            return Response(error_code.LIMIT_NOT_INT, status=400)
+
+        limit = max(1, min(limit, settings.CHAT_MESSAGES_MAX_PAGE_SIZE))
+
+        if not request.GET.get('cursor'):
+            page = hot_pages.page(group.pk, limit)
+
+            if page is not None:
+                messages, more = page
+                return Response({'results': personalize(messages, request),
+                                 'next_cursor': get_next_cursor(messages) if more and messages else None})
+
+        qs = group.messages.select_related('author').prefetch_related('images').order_by('-created_at', '-id')
+
+        if request.GET.get('cursor'):
+            cursor = decode_cursor(request.GET.get('cursor'))
+
+            if cursor is None:
+                return Response(error_code.INVALID_CURSOR, status=400)
+
+            created_at, pk = cursor
+            qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+
+        messages = list(qs[:limit + 1])
+        next_cursor = None
+
+        if len(messages) > limit:
+            messages = messages[:limit]
+            next_cursor = encode_cursor(messages[-1].created_at, messages[-1].pk)
+
+        serializer = MessageSerializer(messages,
+                                       many=True,
+                                       read_only=True,
+                                       context={'request': request})
+
+        return Response({'results': serializer.data, 'next_cursor': next_cursor})
+
+
+class SearchMessages(APIView):
+    # ?q=<words>&cursor=<next_cursor of the previous page>&limit=<n>, in one room or in all of my rooms
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, room_pk=None):
+        query = request.GET.get('q')
+
+        if query is None or not query.strip():
+            return Response(error_code.NO_QUERY, status=400)
+
+        if room_pk is not None and not get_object_or_404(ChatRoom, pk=room_pk).is_user_in_chat_room(request.user):
+            return Response(error_code.USER_NOT_MEMBER, status=403)
+
+        try:
+            limit = int(request.GET.get('limit') or settings.CHAT_MESSAGES_PAGE_SIZE)
+        except ValueError:
+            return Response(error_code.LIMIT_NOT_INT, status=400)
+
+        limit = max(1, min(limit, settings.CHAT_MESSAGES_MAX_PAGE_SIZE))
+        cursor = None
+
+        if request.GET.get('cursor'):
+            cursor = decode_cursor(request.GET.get('cursor'))
+
+            if cursor is None:
+                return Response(error_code.INVALID_CURSOR, status=400)
+
+        messages, more = search_messages(query, request.user, room=room_pk, cursor=cursor, limit=limit)
+        next_cursor = encode_cursor(messages[-1].created_at, messages[-1].pk) if more else None
+
+        serializer = MessageSearchSerializer(messages,
+                                             many=True,
+                                             read_only=True,
+                                             context={'request': request, 'query': query})
+
+        return Response({'results': serializer.data, 'next_cursor': next_cursor})
+
 
 class GetChatRoomInfo(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request, chatroom_pk):
-        chat_room = get_object_or_404(ChatRoom, pk=chatroom_pk)
+        chat_room = get_object_or_404(ChatRoom.objects.prefetch_related('users__friends', 'creators__friends'),
+                                      pk=chatroom_pk)
 
-        if request.user not in chat_room.users.all():
+        if not chat_room.is_user_in_chat_room(request.user):
             return Response(error_code.USER_NOT_MEMBER, status=403)
 
         serializer = GroupSerializer(chat_room, context={'request': request})
@@ -112,7 +208,7 @@ class InviteUser(APIView):
     def post(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         if request.data.get('user') is None:
@@ -126,7 +222,7 @@ class InviteUser(APIView):
         if ChatroomInvitation.objects.filter(receiver=receiver, chatroom=chatroom).exists():
             return Response(error_code.SAME_INVITATION_EXISTS, status=400)
 
-        if request.data.get('user') in chatroom.users.all():
+        if chatroom.is_user_in_chat_room(receiver):
             return Response(error_code.USER_IS_MEMBER, status=400)
 
         ChatroomInvitation.objects.create(sender=request.user, receiver=receiver, chatroom=chatroom)
@@ -140,7 +236,7 @@ class RemoveUser(APIView):
     def delete(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         if request.data.get('user') is None:
@@ -151,13 +247,11 @@ class RemoveUser(APIView):
         if user == request.user:
             return Response(error_code.CANT_REMOVE_YOURSELF, status=400)
 
-        if request.data.get('user') in chatroom.users.all():
+        if not chatroom.is_user_in_chat_room(user):
             return Response(error_code.USER_NOT_MEMBER, status=400)
 
         chatroom.users.remove(user)
-
-        if user in chatroom.creators.all():
-            chatroom.creators.remove(user)
+        chatroom.creators.remove(user)
 
         chatroom.save()
 
@@ -170,7 +264,7 @@ class CancelRequest(APIView):
     def delete(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         if request.data.get('user') is None:
@@ -184,7 +278,7 @@ class CancelRequest(APIView):
         if not ChatroomInvitation.objects.filter(receiver=receiver, chatroom=chatroom).exists():
             return Response(error_code.INVITATION_DOESNT_EXISTS, status=400)
 
-        if request.data.get('user') in chatroom.users.all():
+        if chatroom.is_user_in_chat_room(receiver):
             return Response(error_code.USER_IS_MEMBER, status=400)
 
         ChatroomInvitation.objects.get(receiver=receiver, chatroom=chatroom).delete()
@@ -231,17 +325,15 @@ class LeaveChatroom(APIView):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
         user = request.user
 
-        if user not in chatroom.users.all():
+        if not chatroom.is_user_in_chat_room(user):
             return Response(error_code.USER_NOT_MEMBER, status=400)
 
         chatroom.users.remove(user)
-
-        if user in chatroom.creators.all():
-            chatroom.creators.remove(user)
+        chatroom.creators.remove(user)
 
         chatroom.save()
 
-        if len(chatroom.users.all()) <= 0:
+        if not chatroom.users.exists():
             chatroom.delete()
 
         return Response(status=204)
@@ -253,7 +345,7 @@ class DeleteChatRoom(APIView):
     def delete(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=400)
 
         chatroom.delete()
@@ -267,14 +359,14 @@ class AddAdmin(APIView):
     def post(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         user = request.data.get('user')
 
         user = get_object_or_404(get_user_model(), pk=user)
 
-        if user not in chatroom.users.all():
+        if not chatroom.is_user_in_chat_room(user):
             return Response(error_code.PK_USER_NOT_MEMBER, status=400)
 
         chatroom.creators.add(user)
@@ -289,14 +381,14 @@ class DeleteAdmin(APIView):
     def delete(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         user = request.data.get('user')
 
         user = get_object_or_404(get_user_model(), pk=user)
 
-        if user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(user):
             return Response(error_code.PK_USER_NOT_ADMIN, status=400)
 
         chatroom.creators.remove(user)
@@ -318,10 +410,7 @@ class SearchForChatroomUser(APIView):
 
         offset, limit = validate_offset_and_limit(request)
 
-        queryset = get_user_model().objects.annotate(
-            fullname=Concat('first_name', Value(' '), 'last_name'))
-
-        users = queryset.filter(Q(fullname__startswith=name) | Q(username__contains=name))[offset:limit]
+        users = chatroom.annotate_user_flags(search_users(name, offset, limit))
 
         serializer = ChatroomUserSearchSerializer(users, many=True, context={'request': request, 'chatroom': chatroom})
         return Response(serializer.data)
@@ -333,7 +422,7 @@ class EditChatRoom(APIView):
     def post(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         if request.data.get('name') is not None:
@@ -349,7 +438,7 @@ class AddChatRoomPicture(APIView):
     def post(self, request, chatroom_pk):
         chatroom = get_object_or_404(ChatRoom, pk=chatroom_pk)
 
-        if request.user not in chatroom.creators.all():
+        if not chatroom.is_user_admin(request.user):
             return Response(error_code.USER_NOT_ADMIN, status=403)
 
         if not request.FILES.get('image'):
@@ -362,10 +451,34 @@ class AddChatRoomPicture(APIView):
 
         image = Image.open(image)
 
-        content_file = cut(image)
-        filename = f'{str(uuid.uuid4())[:12]}.{image.format.lower()}'
-
-        chatroom.image.save(filename, content_file)
+        chatroom.image_variants = save_variants(chatroom.image, 'image.jpg', cut(image))
         chatroom.save()
 
         return Response(status=201)
+
+
+class GetWorkerStats(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response({
+            'connections': ChatConsumer.connections,
+            'db_pool': db_executor.stats(),
+            'outbox': Outbox.stats(),
+            'throttle': ConnectionThrottle.stats(),
+        })
+
+
+class GetMessageThumbnail(APIView):
+    # Public like the /media/ url of the original, name is its storage name. A thumbnail of a given
+    # image and size never changes, so clients and proxies may keep it forever.
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, size, name):
+        path = thumbnails.get(name, size)
+
+        if path is None:
+            return Response(error_code.NO_IMAGE, status=404)
+
+        return serve_file(request, path, thumbnails.content_type(name), immutable=True)
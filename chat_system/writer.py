@@ -0,0 +1,177 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .hot_page import hot_pages
+from .models import ChatRoom, Message, MessageTerm
+from .search import get_message_terms
+from .serializer import WSFriendSerializer, get_new_message_data
+
+logger = logging.getLogger(__name__)
+
+
+class SnowflakeIds:
+    # Time ordered ids made without the database: 41 bits of milliseconds since epoch, 5 bits of writer id
+    # and 7 bits of sequence. 53 bits in total, so JavaScript clients read them exactly.
+    epoch = 1640995200000
+    worker_bits = 5
+    sequence_bits = 7
+
+    def __init__(self, worker_id):
+        # Two processes with the same id make the same ids, and the later message fails to be written
+        if not isinstance(worker_id, int) or not 0 <= worker_id < 1 << self.worker_bits:
+            raise ImproperlyConfigured(f'CHAT_WRITER_ID has to be set to an id from 0 to {(1 << self.worker_bits) - 1} '
+                                       'that no other process writing to the database uses')
+
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = 0
+        self.sequence = 0
+
+    def next(self):
+        with self.lock:
+            ms = int(time.time() * 1000)
+
+            if ms <= self.last_ms:
+                # Same millisecond, or the clock went back: continue from the last one
+                ms = self.last_ms
+                self.sequence = (self.sequence + 1) % (1 << self.sequence_bits)
+
+                if self.sequence == 0:
+                    ms += 1
+            else:
+                self.sequence = 0
+
+            self.last_ms = ms
+
+            return ((ms - self.epoch) << (self.worker_bits + self.sequence_bits)
+                    | self.worker_id << self.sequence_bits
+                    | self.sequence)
+
+
+class MessageWriter:
+    # Write-behind persistence of new messages (CHAT_WRITE_BEHIND). ChatConsumer gets the id and timestamp
+    # right away and broadcasts, one writer thread inserts whatever queued up in a single transaction
+    # (bulk_create, room pointers, search terms), waiting at most interval for a batch to fill. With sqlite
+    # that is one lock and one commit for a batch instead of one per message. A message that can not be
+    # written is reported to the on_failure callback it was queued with, it has been broadcast already.
+    def __init__(self, enabled, interval, batch_size, worker_id):
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.ids = SnowflakeIds(worker_id) if enabled else None
+        self.queue = queue.Queue()
+        self.condition = threading.Condition()
+        self.enqueued = 0
+        self.written = 0
+        self.thread = None
+
+    def prepare(self, author, room, content, pending_images, client_msg_id=None):
+        return Message(pk=self.ids.next(),
+                       author=author,
+                       chat_room_id=room,
+                       content=content,
+                       pending_images=pending_images,
+                       client_msg_id=client_msg_id,
+                       created_at=timezone.now())
+
+    def enqueue(self, message, on_failure=None):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='chat-message-writer', daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+
+            self.enqueued += 1
+            self.queue.put((message, on_failure))
+
+    def flush(self, timeout=10):
+        # Wait until every message queued so far is written, e.g. before editing one of them
+        with self.condition:
+            target = self.enqueued
+            return self.condition.wait_for(lambda: self.written >= target, timeout)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                self.write(batch)
+            finally:
+                with self.condition:
+                    self.written += len(batch)
+                    self.condition.notify_all()
+
+    def write(self, batch):
+        # batch: (message, on_failure) pairs
+        close_old_connections()
+        written = [message for message, on_failure in batch]
+
+        try:
+            with transaction.atomic():
+                self.insert(written)
+        except Exception:
+            # One bad message (e.g. its room was deleted meanwhile) must not take the batch with it
+            logger.exception('Batch of %s messages failed, writing them one by one', len(batch))
+            written = []
+
+            for message, on_failure in batch:
+                try:
+                    with transaction.atomic():
+                        self.insert([message])
+                    written.append(message)
+                except Exception:
+                    logger.exception('Message %s could not be written', message.pk)
+                    self.report(message, on_failure)
+
+        authors = {}
+        rooms = {}
+        for message in written:
+            if message.author_id not in authors:
+                authors[message.author_id] = WSFriendSerializer(message.author).data
+
+            rooms.setdefault(message.chat_room_id, []).append(get_new_message_data(message, authors[message.author_id]))
+
+        for room, payloads in rooms.items():
+            hot_pages.push(room, payloads)
+
+    @staticmethod
+    def report(message, on_failure):
+        if on_failure is None:
+            return
+
+        try:
+            on_failure(message)
+        except Exception:
+            logger.exception('Failure of message %s could not be reported', message.pk)
+
+    @staticmethod
+    def insert(messages):
+        Message.objects.bulk_create(messages)
+
+        latest = {}
+        for message in messages:
+            latest[message.chat_room_id] = message
+
+        for room, message in latest.items():
+            ChatRoom.set_last_message(room, message)
+
+        MessageTerm.objects.bulk_create([term for message in messages for term in get_message_terms(message)])
+
+
+message_writer = MessageWriter(enabled=settings.CHAT_WRITE_BEHIND,
+                               interval=settings.CHAT_WRITE_BEHIND_INTERVAL,
+                               batch_size=settings.CHAT_WRITE_BEHIND_BATCH,
+                               worker_id=settings.CHAT_WRITER_ID)
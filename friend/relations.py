@@ -0,0 +1,93 @@
+from django.contrib.auth.models import AnonymousUser
+from .models import FriendList, FriendRequest
+
+
+def get_friend_type(user_id, requested, invited, friends):
+    if user_id in requested:
+        return "requested"
+    elif user_id in invited:
+        return "invited"
+    elif user_id in friends:
+        return "friend"
+    else:
+        return "none"
+
+
+def relationship_group_name(user_id):
+    return f'relationships_{user_id}'
+
+
+class RelationshipOverlay:
+    # Relationship state of one viewer towards everybody else, loaded with three queries when a websocket
+    # connects so broadcasts can be personalized without touching the database. friend.signals tells the
+    # user's relationship_group_name group when it changes, the socket then loads it again.
+    def __init__(self, user):
+        self.user = user
+        self.requested = set()
+        self.invited = set()
+        self.friends = set()
+
+    def load(self):
+        if self.user.is_authenticated:
+            self.requested = set(
+                FriendRequest.objects.filter(receiver=self.user).values_list('sender_id', flat=True))
+            self.invited = set(
+                FriendRequest.objects.filter(sender=self.user).values_list('receiver_id', flat=True))
+            self.friends = set(
+                FriendList.friends.through.objects.filter(friendlist__owner=self.user)
+                                          .values_list('customuser_id', flat=True))
+
+    def friend_type(self, user_id):
+        if not self.user.is_authenticated:
+            return "none"
+
+        return get_friend_type(user_id, self.requested, self.invited, self.friends)
+
+
+class FriendTypeResolver:
+    # Relationship state of one viewer towards a batch of users, three queries per batch instead of
+    # three per user. Serializers share one resolver through their context, see get_friend_resolver.
+    def __init__(self, user):
+        self.user = user
+        self.types = {}
+
+    def prime(self, user_ids):
+        user_ids = {user_id for user_id in user_ids if user_id and user_id not in self.types}
+
+        if not user_ids or not self.user.is_authenticated:
+            return
+
+        requested = set(FriendRequest.objects.filter(receiver=self.user, sender_id__in=user_ids)
+                                             .values_list('sender_id', flat=True))
+        invited = set(FriendRequest.objects.filter(sender=self.user, receiver_id__in=user_ids)
+                                           .values_list('receiver_id', flat=True))
+        friends = set(FriendList.friends.through.objects.filter(friendlist__owner=self.user,
+                                                                customuser_id__in=user_ids)
+                                                        .values_list('customuser_id', flat=True))
+
+        for user_id in user_ids:
+            self.types[user_id] = get_friend_type(user_id, requested, invited, friends)
+
+    def friend_type(self, user):
+        # user is a user or its pk
+        user_id = getattr(user, 'pk', user)
+
+        if not self.user.is_authenticated:
+            return "none"
+
+        if user_id not in self.types:
+            self.prime([user_id])
+
+        return self.types.get(user_id, "none")
+
+
+def get_friend_resolver(context):
+    resolver = context.get('friend_resolver')
+
+    if resolver is None:
+        request = context.get('request')
+        user = request.user if request is not None else context.get('user')
+        resolver = FriendTypeResolver(user if user is not None else AnonymousUser())
+        context['friend_resolver'] = resolver
+
+    return resolver
@@ -1,10 +1,23 @@
+from django.db import models
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from .models import FriendList, FriendRequest
+from .relations import get_friend_resolver
+from user.imgs import ImageVariantsField
+
+
+class FriendTypeListSerializer(serializers.ListSerializer):
+    # Resolves friend_type for every user on the page in one batch, the child serializer says which
+    # users it is going to show through get_friend_type_ids
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, models.Manager) else data)
+        get_friend_resolver(self.context).prime(self.child.get_friend_type_ids(items))
+        return super().to_representation(items)
 
 
 class FriendSerializer(serializers.ModelSerializer):
     full_name = serializers.ReadOnlyField()
+    pfp_variants = ImageVariantsField()
     friend_type = serializers.SerializerMethodField()
 
     class Meta:
@@ -15,21 +28,16 @@ class FriendSerializer(serializers.ModelSerializer):
                   'last_name',
                   'full_name',
                   'friend_type',
-                  'pfp']
+                  'pfp',
+                  'pfp_variants']
+        list_serializer_class = FriendTypeListSerializer
+
+    @staticmethod
+    def get_friend_type_ids(users):
+        return [user.pk for user in users]
 
     def get_friend_type(self, user):
-        request_user = self.context.get('request').user
-        if not request_user.is_authenticated:
-            return "none"
-
-        if FriendRequest.objects.filter(sender=user, receiver=request_user).exists():
-            return "requested"
-        elif FriendRequest.objects.filter(sender=request_user, receiver=user).exists():
-            return "invited"
-        elif request_user.friend_list.is_friend(user):
-            return "friend"
-        else:
-            return "none"
+        return get_friend_resolver(self.context).friend_type(user)
 
 
 class FriendListSerializer(serializers.ModelSerializer):
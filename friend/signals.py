@@ -0,0 +1,43 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .models import FriendList, FriendRequest
+from .relations import relationship_group_name
+
+
+def relationships_changed(user_ids):
+    # Sockets of the users reload their RelationshipOverlay, once the change is visible to them
+    user_ids = set(user_ids)
+
+    def send():
+        channel_layer = get_channel_layer()
+
+        for user_id in user_ids:
+            async_to_sync(channel_layer.group_send)(relationship_group_name(user_id),
+                                                    {'type': 'relationships_changed'})
+
+    if user_ids:
+        transaction.on_commit(send)
+
+
+@receiver(post_save, sender=FriendRequest)
+@receiver(post_delete, sender=FriendRequest)
+def friend_request_changed(sender, instance, **kwargs):
+    relationships_changed([instance.sender_id, instance.receiver_id])
+
+
+@receiver(m2m_changed, sender=FriendList.friends.through)
+def friend_list_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        # The friend lists a user is being removed from are only known before the clear happens
+        relationships_changed(FriendList.objects.filter(friends=instance).values_list('owner_id', flat=True))
+
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        relationships_changed([instance.owner_id])
+    elif pk_set:
+        relationships_changed(FriendList.objects.filter(pk__in=pk_set).values_list('owner_id', flat=True))
@@ -1,6 +1,13 @@
-from PIL import Image
+import os
+from PIL import Image, features
 from io import BytesIO
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from rest_framework import serializers
+
+# Extension of each variant format, formats this Pillow build can not write are skipped
+EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp'}
 
 
 def crop_center(pil_img, crop_width, crop_height):
@@ -15,16 +22,77 @@ def crop_max_square(pil_img):
     return crop_center(pil_img, min(pil_img.size), min(pil_img.size))
 
 
-def cut(img):
-    img = img.convert('RGB')
+def get_formats():
+    return [image_format for image_format in settings.IMAGE_VARIANT_FORMATS
+            if image_format != 'webp' or features.check('webp')]
 
-    img = crop_max_square(img).resize((512, 512), Image.LANCZOS)
 
+def encode(img, image_format):
     f = BytesIO()
     try:
-        img.save(f, format='jpeg')
-        # user.pfp.save(filename, ContentFile(f.getvalue()))
-        # user.save()
+        img.save(f, format=image_format, quality=settings.IMAGE_VARIANT_QUALITY)
         return ContentFile(f.getvalue())
     finally:
         f.close()
+
+
+def cut(img, sizes=None):
+    # Square crops of img in every size and format, {size: {format: ContentFile}}. JPEGs are decoded at
+    # the smallest scale still covering the largest size (draft), every size is resized from the next
+    # larger one instead of from the full image.
+    sizes = sorted(sizes or settings.IMAGE_VARIANT_SIZES, reverse=True)
+
+    if img.format == 'JPEG':
+        img.draft('RGB', (sizes[0], sizes[0]))
+
+    img = crop_max_square(img.convert('RGB'))
+    variants = {}
+
+    for size in sizes:
+        img = img.resize((size, size), Image.LANCZOS)
+        variants[size] = {image_format: encode(img, image_format) for image_format in get_formats()}
+
+    return variants
+
+
+def save_variants(field_file, filename, variants):
+    # The largest JPEG goes to the image field as before, the rest next to it. Returns the storage names
+    # of all of them for the model's variants field.
+    stem = os.path.splitext(filename)[0]
+    largest = max(variants)
+    field_file.save(f'{stem}.jpg', variants[largest]['jpeg'], save=False)
+    names = {}
+
+    for size, files in variants.items():
+        names[str(size)] = {}
+
+        for image_format, content in files.items():
+            if size == largest and image_format == 'jpeg':
+                name = field_file.name
+            else:
+                name = field_file.field.generate_filename(field_file.instance,
+                                                          f'{stem}_{size}.{EXTENSIONS[image_format]}')
+                name = field_file.storage.save(name, content)
+
+            names[str(size)][image_format] = name
+
+    return names
+
+
+def get_variant_urls(variants, request=None):
+    # {size: {format: url}} of a variants field, absolute when there is a request
+    urls = {}
+
+    for size, names in (variants or {}).items():
+        urls[size] = {}
+
+        for image_format, name in names.items():
+            url = default_storage.url(name)
+            urls[size][image_format] = request.build_absolute_uri(url) if request is not None else url
+
+    return urls
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    def to_representation(self, value):
+        return get_variant_urls(value, self.context.get('request'))
@@ -1,14 +1,17 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from friend.serializer import FriendListSerializer
-from friend.models import FriendList, FriendRequest
+from friend.models import FriendList
+from friend.relations import get_friend_resolver
 from chat_system.serializer import ChatRoomInvitationSerializer
+from .imgs import ImageVariantsField
 
 
 class UserSerializer(serializers.ModelSerializer):
     full_name = serializers.ReadOnlyField()
     friends = serializers.SerializerMethodField()
     friend_type = serializers.SerializerMethodField()
+    pfp_variants = ImageVariantsField()
 
     class Meta:
         model = get_user_model()
@@ -19,6 +22,7 @@ class UserSerializer(serializers.ModelSerializer):
                   'last_name',
                   'full_name',
                   'pfp',
+                  'pfp_variants',
                   'friends',
                   'friend_type']
 
@@ -27,24 +31,14 @@ class UserSerializer(serializers.ModelSerializer):
         return FriendListSerializer(query_set, context={'request': self.context.get('request')}).data.get('friends')
 
     def get_friend_type(self, user):
-        request_user = self.context.get('request').user
-        if not request_user.is_authenticated:
-            return "none"
-
-        if FriendRequest.objects.filter(sender=user, receiver=request_user).exists():
-            return "requested"
-        elif FriendRequest.objects.filter(sender=request_user, receiver=user).exists():
-            return "invited"
-        elif request_user.friend_list.is_friend(user):
-            return "friend"
-        else:
-            return "none"
+        return get_friend_resolver(self.context).friend_type(user)
 
 
 class MeSerializer(serializers.ModelSerializer):
     full_name = serializers.ReadOnlyField()
     friends = serializers.SerializerMethodField()
     chatroom_invitations = ChatRoomInvitationSerializer(many=True, read_only=True)
+    pfp_variants = ImageVariantsField()
 
     class Meta:
         model = get_user_model()
@@ -55,6 +49,7 @@ class MeSerializer(serializers.ModelSerializer):
                   'last_name',
                   'full_name',
                   'pfp',
+                  'pfp_variants',
                   'friends',
                   'chatroom_invitations']
 
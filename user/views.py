@@ -1,7 +1,5 @@
 from django.contrib.auth import get_user_model
 from django.shortcuts import get_object_or_404
-from django.db.models.functions import Concat
-from django.db.models import Value, Q
 from django.contrib.auth.password_validation import validate_password
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
@@ -9,13 +7,13 @@ from rest_framework.parsers import MultiPartParser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
-import uuid
 from PIL import Image
 from .serializer import UserSerializer, MeSerializer
 from friend.serializer import FriendSerializer
-from .imgs import cut
+from .imgs import cut, save_variants
 from . import error_code
 from Carrier.general_functions import validate_offset_and_limit
+from auth_system.search import search_users
 
 
 class GetUser(APIView):
@@ -115,10 +113,7 @@ class GetUserByName(APIView):
             offset, limit = validate_offset_and_limit(request)
             name = request.query_params.get('name')
 
-            queryset = get_user_model().objects.annotate(
-                fullname=Concat('first_name', Value(' '), 'last_name'))
-
-            users = queryset.filter(Q(fullname__startswith=name) | Q(username__contains=name))[offset:limit]
+            users = search_users(name, offset, limit)
 
             serializer = FriendSerializer(users, many=True, context={'request': request})
             return Response(serializer.data)
@@ -235,10 +230,8 @@ class AddProfilePicture(APIView):
 
             img = Image.open(img)
 
-            content_file = cut(img)
-            filename = f'{str(uuid.uuid4())[:12]}.{img.format.lower()}'
-
-            user.pfp.save(filename, content_file)
+            user.pfp_variants = save_variants(user.pfp, 'pfp.jpg', cut(img))
+            user.save(update_fields=['pfp', 'pfp_variants'])
 
             return Response(status=201)
         return Response(error_code.NO_PFP, status=400)